@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# The protocol module is shared with the client and server.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SHARED DIRECTORY'))
+import protocol
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SERVER DIRECTORY', 'server.py')
+HOST = '127.0.0.1'
+# How long to wait for a server to start accepting connections.
+START_TIMEOUT = 10
+# The mixes of operations the load generator can run, each operation with its weight.
+MIXES = {
+    'upload': {'UPLD': 1},
+    'download': {'DWLD': 1},
+    'list': {'LIST': 1},
+    'mixed': {'UPLD': 3, 'DWLD': 5, 'LIST': 1, 'DELF': 1},
+}
+# The file downloaded by DWLD, uploaded once before each run.
+SEED_FILE = 'bench-seed'
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    # Sizes are given as a number of bytes, optionally followed by K, M or G.
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_list(text, parse=int):
+    return [parse(item) for item in text.split(',') if item.strip() != '']
+
+
+def free_port():
+    # Ask the operating system for a port nothing is listening on.
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def syscall_counts(pid):
+    # The read and write syscalls the process has made so far, None where /proc/<pid>/io
+    # isn't available.
+    try:
+        with open('/proc/' + str(pid) + '/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['syscr']) + int(counters['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def start_server(directory, port, chunk_size, server_arguments):
+    # Run server.py in its own directory, so it keeps its SERVER FILES there, and wait until it
+    # accepts connections.
+    process = subprocess.Popen([sys.executable, SERVER, '--host', HOST, '--port', str(port),
+                                '--chunk-size', str(chunk_size)] + server_arguments,
+                               cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with status ' + str(process.returncode) + '.')
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start within ' + str(START_TIMEOUT) + ' seconds.')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=START_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def connect(port):
+    # Connect and agree on the current protocol version, as the client does.
+    sock = socket.create_connection((HOST, port))
+    protocol.tune_socket(sock)
+    sock.sendall(protocol.CONN)
+    connection = protocol.Connection(sock)
+    protocol.negotiate(connection)
+    return connection
+
+
+def upload(connection, file_name, source, size, buffer):
+    # Returns the number of body bytes moved.
+    connection.sendall(protocol.UPLD + protocol.pack_name(file_name) + protocol.pack_options({}))
+    acknowledgement = connection.reader.read_exact(3)
+    options = connection.reader.read_options()
+    if acknowledgement != protocol.ACK:
+        raise protocol.ProtocolError(options.get('error', 'upload refused.'))
+    connection.sendall(protocol.pack_size(size))
+    with open(source, 'rb') as f:
+        protocol.send_file(connection.sock, f, size, buffer)
+    received = connection.reader.read_size()
+    connection.reader.read_options()
+    return received
+
+
+def download(connection, file_name, buffer):
+    connection.sendall(protocol.DWLD + protocol.pack_name(file_name) + protocol.pack_options({}))
+    size = connection.reader.read_size(signed=True)
+    connection.reader.read_options()
+    if size == -1:
+        return 0
+    # The body is received and thrown away, the benchmark measures the transfer not our disk.
+    received = protocol.discard_bytes(connection.reader, size, buffer)
+    connection.reader.read_options()
+    return received
+
+
+def list_files(connection):
+    connection.sendall(protocol.LIST + protocol.pack_options({'limit': 1000}))
+    connection.reader.read_options()
+    return 0
+
+
+def delete(connection, file_name):
+    connection.sendall(protocol.DELF + protocol.pack_name(file_name))
+    if connection.reader.read_int(2, signed=True) == 1:
+        connection.sendall(protocol.pack_string('YES'))
+        connection.reader.read_string()
+    return 0
+
+
+def run_client(port, client_id, script, source, size, chunk_size, results):
+    # One client of the load generator, it performs the operations of the script in order and
+    # records how long each one took.
+    buffer = bytearray(chunk_size)
+    uploaded = []
+    latencies = []
+    bytes_moved = 0
+    errors = 0
+    connection = connect(port)
+    try:
+        for number, operation in enumerate(script):
+            start_time = time.perf_counter()
+            try:
+                if operation == 'UPLD':
+                    file_name = 'bench-' + str(client_id) + '-' + str(number)
+                    bytes_moved += upload(connection, file_name, source, size, buffer)
+                    uploaded.append(file_name)
+                elif operation == 'DWLD':
+                    bytes_moved += download(connection, SEED_FILE, buffer)
+                elif operation == 'LIST':
+                    list_files(connection)
+                elif operation == 'DELF':
+                    # Delete one of our own uploads, or a file that doesn't exist if there are none.
+                    delete(connection, uploaded.pop() if uploaded else 'bench-missing')
+            except protocol.ProtocolError:
+                errors += 1
+            latencies.append((operation, time.perf_counter() - start_time))
+        connection.sendall(protocol.QUIT)
+    finally:
+        connection.close()
+    results.append({'latencies': latencies, 'bytes': bytes_moved, 'errors': errors})
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def latency_summary(latencies):
+    return {'count': len(latencies), 'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}
+
+
+def make_script(mix, operations, seed):
+    # The operations one client performs, drawn from the mix with a fixed seed so runs repeat.
+    rng = random.Random(seed)
+    names = list(MIXES[mix])
+    return rng.choices(names, weights=[MIXES[mix][name] for name in names], k=operations)
+
+
+def run(port, server_pid, source, size, chunk_size, concurrency, mix, operations, script=None):
+    # Run concurrency clients at once against the server and summarise how they did.
+    scripts = [script or make_script(mix, operations, client_id) for client_id in range(concurrency)]
+    results = []
+    clients = [threading.Thread(target=run_client,
+                                args=(port, client_id, scripts[client_id], source, size, chunk_size, results))
+               for client_id in range(concurrency)]
+    server_syscalls = syscall_counts(server_pid)
+    client_syscalls = syscall_counts(os.getpid())
+    start_time = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start_time
+    latencies = [latency for result in results for latency in result['latencies']]
+    bytes_moved = sum(result['bytes'] for result in results)
+    megabytes = bytes_moved / (1024 * 1024)
+    summary = {
+        'file_size': size,
+        'chunk_size': chunk_size,
+        'concurrency': concurrency,
+        'mix': mix,
+        'operations': len(latencies),
+        'failed_clients': concurrency - len(results),
+        'errors': sum(result['errors'] for result in results),
+        'seconds': elapsed,
+        'bytes': bytes_moved,
+        'throughput_mb_per_s': megabytes / elapsed if elapsed else None,
+        'operations_per_s': len(latencies) / elapsed if elapsed else None,
+        'latency': latency_summary([seconds for operation, seconds in latencies]),
+        'latency_by_operation': dict(
+            (name, latency_summary([seconds for operation, seconds in latencies if operation == name]))
+            for name in sorted(set(operation for operation, seconds in latencies))),
+    }
+    # Syscalls per MB moved, for the server and for the load generator itself.
+    for side, before, pid in (('server', server_syscalls, server_pid), ('client', client_syscalls, os.getpid())):
+        after = syscall_counts(pid)
+        if before is None or after is None or not megabytes:
+            summary[side + '_syscalls_per_mb'] = None
+        else:
+            summary[side + '_syscalls_per_mb'] = (after - before) / megabytes
+    return summary
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Start server.py on a loopback port and benchmark it.')
+    parser.add_argument('--sizes', default='1K,1M,64M', type=lambda text: parse_list(text, parse_size),
+                        help='file sizes to sweep, e.g. 1K,1M,1G,10G, files are sparse so large sizes are cheap '
+                             'to create but the server still stores what is uploaded')
+    parser.add_argument('--chunk-sizes', default=str(protocol.CHUNK_SIZE), type=lambda text: parse_list(text, parse_size),
+                        help='server --chunk-size values to sweep, a server is started for each')
+    parser.add_argument('--concurrency', default='1,4,16', type=parse_list, help='numbers of clients to sweep')
+    parser.add_argument('--mixes', default='upload,download,mixed', type=lambda text: parse_list(text, str),
+                        help='operation mixes to sweep, from ' + ', '.join(MIXES))
+    parser.add_argument('--operations', type=int, default=20, help='operations per client per run')
+    parser.add_argument('--max-bytes', type=parse_size, default=parse_size('2G'),
+                        help='fewer operations are run for large files so a run moves about this much')
+    parser.add_argument('--script', default=None,
+                        help='a JSON file listing the operations, e.g. ["UPLD", "LIST", "DWLD"], every client '
+                             'performs in place of the mixes')
+    parser.add_argument('--server-args', default='', help='further arguments for server.py, e.g. "--storage chunked"')
+    parser.add_argument('--output', default=None, help='write the JSON report here rather than to stdout')
+    args = parser.parse_args()
+    for mix in args.mixes:
+        if mix not in MIXES:
+            parser.error('unknown mix ' + mix + ', choose from ' + ', '.join(MIXES) + '.')
+    return args
+
+
+def main():
+    args = parse_arguments()
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    mixes = ['script'] if script else args.mixes
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    report = {'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                          'cpus': os.cpu_count(), 'zero_copy': protocol.ZERO_COPY},
+              'runs': []}
+    try:
+        for chunk_size in args.chunk_sizes:
+            for size in args.sizes:
+                # A sparse file of the size to upload, reading its holes costs no disk I/O.
+                source = os.path.join(directory, 'source')
+                with open(source, 'wb') as f:
+                    f.truncate(size)
+                # Every chunk size and file size gets a fresh server with empty storage.
+                shutil.rmtree(os.path.join(directory, 'SERVER FILES'), ignore_errors=True)
+                port = free_port()
+                server = start_server(directory, port, chunk_size, args.server_args.split())
+                try:
+                    # The file every DWLD downloads.
+                    connection = connect(port)
+                    upload(connection, SEED_FILE, source, size, bytearray(chunk_size))
+                    connection.sendall(protocol.QUIT)
+                    connection.close()
+                    for concurrency in args.concurrency:
+                        if concurrency > 1 and size * concurrency > args.max_bytes:
+                            # Even one operation per client would move far more than asked for.
+                            print('skipping size=%d clients=%d, over --max-bytes' % (size, concurrency),
+                                  file=sys.stderr)
+                            continue
+                        operations = max(1, min(args.operations, args.max_bytes // max(1, size * concurrency)))
+                        for mix in mixes:
+                            summary = run(port, server.pid, source, size, chunk_size, concurrency, mix,
+                                          operations, script)
+                            report['runs'].append(summary)
+                            print('%s size=%d chunk=%d clients=%d: %.1f MB/s, p50 %.4fs, p99 %.4fs' % (
+                                mix, size, chunk_size, concurrency, summary['throughput_mb_per_s'] or 0,
+                                summary['latency']['p50'] or 0, summary['latency']['p99'] or 0), file=sys.stderr)
+                finally:
+                    stop_server(server)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,198 @@
+import argparse
+import asyncio
+import contextlib
+import random
 import socket
+import sys
+import threading
 import time
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+# The protocol module is shared with the server.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SHARED DIRECTORY'))
+import chunking
+import compression
+import integrity
+import protocol
 
-def connect():
-    try:
+# The address of the server.
+HOST = '127.0.0.1'
+PORT = 9000
+# How many bytes of a file are moved per read/recv when zero-copy sendfile is not used,
+# anywhere from 256 KiB to 4 MiB keeps transfers at line rate rather than CPU bound.
+CHUNK_SIZE = protocol.CHUNK_SIZE
+# Downloads are written to the file name with this added until they are complete.
+PART_SUFFIX = '.part'
+# How many connections a parallel transfer uses.
+PARALLEL_CONNECTIONS = 4
+# How many bytes each request of a parallel transfer moves, connections pick up rebalanced
+# work between requests.
+SEGMENT_WINDOW = 8 * 1024 * 1024
+# The codecs to offer the server for compressing uploads and downloads, in order of preference,
+# for example ['zstd', 'zlib']. Transfers are not compressed unless a codec is agreed.
+COMPRESSION = []
+# The hash algorithms to offer the server for checking uploads and downloads arrived intact, in
+# order of preference. The file is hashed as it is sent and received, without reading it again.
+CHECKSUMS = integrity.available_algorithms()
+# How many files each request of a listing asks for.
+LIST_PAGE_SIZE = 1000
+# How often a transfer's progress is printed at most, in seconds, however small its pieces.
+PROGRESS_INTERVAL = 0.5
+# How many files a sync transfers at once, each over its own connection.
+SYNC_WORKERS = 4
+# The socket buffer sizes to ask for, None leaves them to the operating system's own tuning.
+SEND_BUFFER = None
+RECEIVE_BUFFER = None
+# How long connecting, and answering a ping, may take before the server is taken as unreachable.
+CONNECT_TIMEOUT = 10
+PING_TIMEOUT = 5
+# How many connections a pool keeps open at most, how often its idle connections are pinged and
+# how long one may be idle before it is closed, in seconds.
+POOL_SIZE = 4
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 300
+# How many times connecting is tried before giving up, waiting from BACKOFF_START seconds after the
+# first failure to BACKOFF_MAX, twice as long each time.
+RECONNECT_ATTEMPTS = 5
+BACKOFF_START = 0.1
+BACKOFF_MAX = 5
+
+
+class Progress:
+    # Prints how far a transfer has got on one line, rewritten no more than every PROGRESS_INTERVAL
+    # seconds so that printing never costs more than the transfer.
+    def __init__(self, label, total, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.printed_at = 0
+        self.printed = False
+
+    def update(self, done):
+        now = time.monotonic()
+        if now - self.printed_at < self.interval:
+            return
+        self.printed_at = now
+        self.printed = True
+        percent = 100 * done // self.total if self.total else 100
+        print('\r' + self.label + ': ' + str(done) + ' of ' + str(self.total) + ' bytes (' + str(percent) + '%)',
+              end='', flush=True)
+
+    def finish(self):
+        # End the progress line, if there was one, before the transfer's own message.
+        if self.printed:
+            print()
+
+
+class SegmentScheduler:
+    # Hands out the byte ranges of a parallel transfer to its connections. The file starts out
+    # split into one segment per connection, a connection that runs out of work takes the second
+    # half of whichever segment has the most left, so slow connections are relieved of work.
+    def __init__(self, size, connections, window):
+        self.lock = threading.Condition()
+        self.window = window
+        step = max(1, -(-size // connections))
+        # Each segment is [next offset to hand out, end].
+        self.segments = [[start, min(start + step, size)] for start in range(0, size, step)]
+        self.unassigned = list(self.segments)
+        # Ranges that failed and must be transferred again by another connection.
+        self.retries = []
+        self.transferred = 0
+        # Bytes handed out and not yet transferred or given back.
+        self.in_flight = 0
+
+    def claim(self, segment):
+        # Return the segment the connection now works on and the offset and length of its next
+        # request, or None when there is nothing left to transfer. While other connections are
+        # still transferring, a connection with nothing to do waits in case one of them fails.
+        with self.lock:
+            while True:
+                work = self.next_request(segment)
+                if work is not None:
+                    self.in_flight += work[2]
+                    return work
+                if self.in_flight == 0:
+                    return None
+                self.lock.wait()
 
-        host = '127.0.0.1'
-        port = 9000
+    def next_request(self, segment):
+        # Called with the lock held.
+        if self.retries:
+            offset, length = self.retries.pop()
+            return segment, offset, length
+        if segment is None or segment[0] >= segment[1]:
+            segment = self.rebalance()
+            if segment is None:
+                return None
+        offset = segment[0]
+        length = min(self.window, segment[1] - offset)
+        segment[0] += length
+        return segment, offset, length
+
+    def rebalance(self):
+        # Called with the lock held, hands out an untouched segment if there is one, otherwise
+        # splits the segment with the most left.
+        if self.unassigned:
+            return self.unassigned.pop(0)
+        busiest = max(self.segments, key=lambda segment: segment[1] - segment[0])
+        remaining = busiest[1] - busiest[0]
+        if remaining <= self.window:
+            # Its owner will be done with it in a request or two, not worth splitting. Should the
+            # owner fail its remainder is handed out again.
+            return None
+        middle = busiest[0] + remaining // 2
+        segment = [middle, busiest[1]]
+        busiest[1] = middle
+        self.segments.append(segment)
+        return segment
+
+    def completed(self, length):
+        with self.lock:
+            self.transferred += length
+            self.in_flight -= length
+            self.lock.notify_all()
+
+    def failed(self, segment, offset, length):
+        # The connection working on segment failed transferring the given range and is gone, the
+        # range and whatever of the segment it hadn't started on are handed out again.
+        with self.lock:
+            self.in_flight -= length
+            self.retries.append((offset, length))
+            if segment is not None and segment[0] < segment[1]:
+                remainder = [segment[0], segment[1]]
+                segment[0] = segment[1]
+                self.segments.append(remainder)
+                self.unassigned.append(remainder)
+            self.lock.notify_all()
+
+
+def connect(host=HOST, port=PORT, codecs=COMPRESSION, checksums=CHECKSUMS):
+    try:
         sock = socket.socket()
+        # Buffer sizes must be set before connecting to take effect.
+        protocol.tune_socket(sock, SEND_BUFFER, RECEIVE_BUFFER)
         # Initiates a TCP server connection with the server binded to the host/port.
+        sock.settimeout(CONNECT_TIMEOUT)
         sock.connect((host, port))
+        sock.settimeout(None)
         # Lets the server know the connection has been initiated.
-        sock.send('CONN'.encode())
-        # Returns the socket that uses the connection.
-        return sock
+        sock.sendall(protocol.CONN)
+        connection = protocol.Connection(sock)
+        # Agree on the protocol version with the server, a compression codec if we have some to offer
+        # and a hash algorithm to check transfers with.
+        options = {'compression': [codec for codec in codecs if codec in compression.CODECS],
+                   'checksums': [algorithm for algorithm in checksums if algorithm in integrity.ALGORITHMS]}
+        server_options = protocol.negotiate(connection, options)
+        connection.compression = compression.choose_codec(server_options.get('compression'))
+        connection.checksum = integrity.choose_algorithm(server_options.get('checksums'))
+        # Returns the connection.
+        return connection
+    except protocol.ProtocolError as e:
+        # If the server doesn't speak our protocol the user is informed of this.
+        sock.close()
+        print('PROTOCOL ERROR: ' + str(e))
     except socket.error:
         # If there was a socket error the user is informed of this.
         print('SOCKET ERROR.')
@@ -23,175 +201,884 @@ def connect():
         print('Could not connect to server.')
 
 
-def upload_file(sock):
-    # User inputs the file name of the file the user wishes to upload to the server.
-    file_name = input('Input the name of the file you wish to upload: ').encode()
-    # File name length is the length of the file in bytes.
-    # It is 2 bytes as the length will always be a short int.
-    file_name_length = len(file_name).to_bytes(2, 'little')
+def connect_with_backoff(host=HOST, port=PORT, codecs=COMPRESSION, checksums=CHECKSUMS, attempts=RECONNECT_ATTEMPTS):
+    # Connect, trying again after a failure up to attempts times in all. The wait doubles after each
+    # failure and is randomised, so clients that lost the server together don't all come back at once.
+    delay = BACKOFF_START
+    for attempt in range(attempts):
+        connection = connect(host, port, codecs, checksums)
+        if connection is not None:
+            return connection
+        if attempt + 1 < attempts:
+            time.sleep(delay * random.uniform(0.5, 1))
+            delay = min(delay * 2, BACKOFF_MAX)
+    return None
+
+
+def ping(connection):
+    # Whether the server still answers on the connection.
+    if 'ping' not in connection.features:
+        # Servers without PING can't be asked, the connection is tried as it is.
+        return True
+    try:
+        connection.sock.settimeout(PING_TIMEOUT)
+        connection.sendall(protocol.PING)
+        return connection.reader.read_exact(4) == protocol.PING
+    except (socket.error, protocol.ProtocolError):
+        return False
+    finally:
+        try:
+            connection.sock.settimeout(None)
+        except socket.error:
+            pass
+
+
+def close_connection(connection):
+    # Let the server know we are done before closing the socket.
+    try:
+        connection.sendall(protocol.QUIT)
+    except socket.error:
+        pass
+    connection.close()
+
+
+class ConnectionPool:
+    # Keeps up to size connections to the server open between operations, so scripts and worker
+    # threads reuse a warm connection rather than connecting and agreeing a version each time.
+    # Idle connections are pinged every heartbeat seconds, which keeps firewalls and NAT from
+    # dropping them and finds the ones that have died, and closed once idle for idle_timeout
+    # seconds. A connection that breaks part way through an operation is closed, not reused.
+    def __init__(self, host=HOST, port=PORT, size=POOL_SIZE, codecs=COMPRESSION, checksums=CHECKSUMS,
+                 heartbeat=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT):
+        self.address = (host, port)
+        self.codecs = codecs
+        self.checksums = checksums
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # [connection, when it was last used, when it was last known alive], most recently used last.
+        self.idle = []
+        # Limits the connections in use at once.
+        self.slots = threading.BoundedSemaphore(size)
+        self.closed = threading.Event()
+        if heartbeat:
+            threading.Thread(target=self.keep_alive, name='heartbeat', daemon=True).start()
+
+    def acquire(self):
+        # Return a connection to use, the most recently used idle one that is still alive or a new
+        # one. Raises ConnectionError if the server can't be reached.
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, last_used, last_alive = self.idle.pop()
+                now = time.monotonic()
+                if now - last_used < self.idle_timeout and (
+                        not self.heartbeat or now - last_alive < self.heartbeat or ping(connection)):
+                    return connection
+                close_connection(connection)
+            connection = connect_with_backoff(*self.address, self.codecs, self.checksums)
+            if connection is None:
+                raise ConnectionError('could not connect to ' + self.address[0] + ':' + str(self.address[1]) + '.')
+            return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, connection, broken=False):
+        if broken or self.closed.is_set():
+            connection.close()
+        else:
+            now = time.monotonic()
+            with self.lock:
+                self.idle.append([connection, now, now])
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        # with pool.connection() as connection: borrows a connection for the block.
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            # Whatever was said last may not have been answered, the connection can't be trusted.
+            self.release(connection, broken=True)
+            raise
+        self.release(connection)
+
+    def keep_alive(self):
+        # Runs on a thread of its own, pinging idle connections and closing those idle too long.
+        while not self.closed.wait(self.heartbeat):
+            now = time.monotonic()
+            with self.lock:
+                # Connections are taken out of the pool while they are pinged.
+                due = [entry for entry in self.idle if now - entry[2] >= self.heartbeat]
+                self.idle = [entry for entry in self.idle if now - entry[2] < self.heartbeat]
+            alive = []
+            for entry in due:
+                if now - entry[1] < self.idle_timeout and ping(entry[0]):
+                    entry[2] = time.monotonic()
+                    alive.append(entry)
+                else:
+                    close_connection(entry[0])
+            with self.lock:
+                # They were used longer ago than any that stayed, so they go back at the front.
+                self.idle[:0] = alive
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used, last_alive in idle:
+            close_connection(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def upload_file(connection, file_name, remote_name=None, progress=False):
+    # Upload the local file file_name, stored on the server as remote_name if one is given. Returns
+    # whether every byte arrived and was stored, with progress printed as it goes if asked for.
+    remote_name = remote_name or file_name
+    if 'dedup' in connection.features and os.path.isfile(file_name):
+        # The server stores content by chunk, so only send the chunks it doesn't hold.
+        return upload_file_deduplicated(connection, file_name, remote_name)
     #If the file exists.
     if os.path.isfile(file_name):
-        # We send the file name length followed by the file name.
-        sock.send(file_name_length)
-        sock.send(file_name)
-        # We received a 3 byte string acknowledgement from the server and decode it.
-        acknowledgment = sock.recv(3).decode()
+        # We get the file size of the file we're uploading.
+        stat = os.stat(file_name)
+        file_size = stat.st_size
+        # The size, modification time and a hash of the start and end of the file let the server
+        # tell whether it holds part of this same file from an interrupted upload.
+        with open(file_name, 'rb') as f:
+            fingerprint = integrity.fingerprint(protocol.file_reader(f), file_size)
+        options = {'resume': {'size': file_size, 'mtime': stat.st_mtime_ns, 'fingerprint': fingerprint}}
+        if connection.compression:
+            # Only compress files that a few samples say will shrink.
+            with open(file_name, 'rb') as f:
+                if compression.compressible(protocol.file_reader(f), 0, file_size):
+                    options['compression'] = connection.compression
+        if connection.checksum:
+            options['checksum'] = connection.checksum
+        # We send the operation, the file name (a 2 byte length followed by the name) and
+        # the options of the upload all at once.
+        connection.sendall(protocol.UPLD + protocol.pack_name(remote_name) + protocol.pack_options(options))
+        # We received a 3 byte string acknowledgement from the server followed by its options.
+        acknowledgment = connection.reader.read_exact(3)
+        options = connection.reader.read_options()
         # If the acknowledgement is 'ACK' we know the server is ready to receive data.
-        if acknowledgment == 'ACK':
-            # We get the file size of the file we're uploading.
-            file_size = os.path.getsize(file_name)
-            # We send the file size as 4 bytes as we know it is a 32 bit value.
-            sock.send(file_size.to_bytes(4, 'little'))
-            bytes_sent = 0
-            # Open the file we're oploading and read its binary.
+        if acknowledgment == protocol.ACK:
+            # The server tells us how many bytes it already holds.
+            offset = options.get('offset', 0)
+            # We send the file size as a 64 bit value.
+            connection.sendall(protocol.pack_size(file_size))
+            # Open the file we're uploading and send the rest of its binary, compressed as it is
+            # read if the server agreed to it.
+            codec = options.get('compression')
+            algorithm = options.get('checksum')
+            meter = Progress('UPLOADING ' + remote_name, file_size) if progress else None
             with open(file_name, 'rb') as f:
-                # Read the first 1024 bytes (up to 1024), if there is less than this
-                # we only read up to 1024.
-                bytes_to_send = f.read(1024)
-                # Send the first bytes we read.
-                sock.send(bytes_to_send)
-                # Increase the number of bytes sent by the number of bytes we just sent.
-                bytes_sent += len(bytes_to_send)
-                # Let the user know what % of the upload we have completed.
-                print('UPLOAD ' + str(round(bytes_sent * 100 / file_size, 2)) + '% COMPLETE')
-                # If there are still bytes to send we repeat the above process.
-                while bytes_sent < file_size:
-                    bytes_to_send = f.read(1024)
-                    sock.send(bytes_to_send)
-                    bytes_sent += len(bytes_to_send)
-                    print('UPLOAD ' + str(round(bytes_sent * 100 / file_size, 2)) + '% COMPLETE')
-            # Receive the number of bytes sent, converting it from 4 bytes to an integer.
-            # (again this value should be up to 32 bits in length).
-            bytes_sent = int.from_bytes(sock.recv(4), byteorder='little')
-            # Receive the process time.
-            process_time = sock.recv(1024).decode()
+                # The whole file is hashed on another thread while it is sent, sendfile never brings
+                # it into our memory to hash it on the way past.
+                background_hash = integrity.BackgroundHash(algorithm, protocol.file_reader(f),
+                                                           file_size) if algorithm else None
+                if codec:
+                    read = protocol.file_reader(f)
+                    if meter is not None:
+                        # Progress is counted as the file is read for compressing.
+                        def read(position, view, read=read):
+                            n = read(position, view)
+                            meter.update(position + n)
+                            return n
+                    compression.send_compressed(connection.sock, read, offset,
+                                                file_size - offset, connection.buffer, codec)
+                else:
+                    f.seek(offset)
+                    protocol.send_file(connection.sock, f, file_size - offset, connection.buffer,
+                                       None if meter is None else lambda sent: meter.update(offset + sent))
+                if meter is not None:
+                    meter.finish()
+                if background_hash is not None:
+                    # Follow the file with its hash, for the server to check against its own.
+                    connection.sendall(protocol.pack_options({'digest': background_hash.hexdigest()}))
+            # Receive the number of bytes the server received and the time it took.
+            bytes_sent = connection.reader.read_size()
+            reply = connection.reader.read_options()
+            process_time = reply['time']
+            if 'error' in reply:
+                print('UPLOAD FAILED: ' + reply['error'])
+                return False
             # Print a string for the user letting them know how the upload went.
             print('UPLOAD COMPLETE in ' + str(round(float(process_time), 2)) + ' seconds, ' + str(
-                bytes_sent) + ' bytes transferred of ' + str(file_size) + ' bytes.')
+                bytes_sent) + ' bytes transferred of ' + str(file_size) + ' bytes' + (
+                ', ' + str(reply.get('wire')) + ' bytes compressed with ' + codec if codec else '') + (
+                ', resumed from ' + str(offset) + ' bytes.' if offset else '.'))
+            return bytes_sent == file_size
         else:
             # If the server didn't send 'ACK' as an acknowledgement, let the user know.
-            print('The server is not ready to receive data.')
+            print('The server is not ready to receive data: ' + options.get('error', ''))
     else:
-        # If the file doesn't exist, send its filename as a blank string and file size as 0.
-        sock.send((0).to_bytes(2, 'little'))
-        sock.send(''.encode())
         # Let the user know the filename wasn't valid.
         print('The filename provided is not a valid file.')
+    return False
+
+
+def upload_file_deduplicated(connection, file_name, remote_name=None):
+    # Split the file into content-defined chunks and ask the server which it doesn't hold.
+    chunks = chunking.chunk_file(file_name)
+    file_size = sum(length for digest, length in chunks)
+    connection.sendall(protocol.DDUP + protocol.pack_name(remote_name or file_name) +
+                       protocol.pack_options({'size': file_size, 'chunks': chunks}))
+    reply = connection.reader.read_options()
+    if 'error' in reply:
+        print('UPLOAD FAILED: ' + reply['error'])
+        return False
+    # Send each missing chunk once, in the order the server listed them, gathering them up
+    # rather than a send each.
+    missing = set(reply['missing'])
+    pending = bytearray()
+    with open(file_name, 'rb') as f:
+        for digest, length in chunks:
+            data = f.read(length)
+            if digest in missing:
+                missing.discard(digest)
+                pending += data
+                if len(pending) >= CHUNK_SIZE:
+                    connection.sendall(pending)
+                    pending.clear()
+    if pending:
+        connection.sendall(pending)
+    reply = connection.reader.read_options()
+    if 'error' in reply:
+        print('UPLOAD FAILED: ' + reply['error'])
+        return False
+    # Print a string for the user letting them know how the upload went.
+    print('UPLOAD COMPLETE in ' + str(round(float(reply['time']), 2)) + ' seconds, ' + str(
+        reply['received']) + ' bytes transferred for ' + str(file_size) + ' bytes' + (
+        ', the server already held the rest.' if reply['received'] < file_size else '.'))
+    return True
 
 
-def list_directory_contents(sock):
-    # Receive the number of files in the server directory.
-    dir_size = int.from_bytes(sock.recv(4), 'little')
-    dir_list = []
-    # Repeat the following for each file in the server directory.
-    for i in range(dir_size):
-        # Receive the size of the file name of the incoming file (again received as
-        # a 2 bytes as its a short int and converted to an int.
-        file_name_size = int.from_bytes(sock.recv(2), 'little')
-        # Receive the file name and decode it.
-        file_name = sock.recv(file_name_size).decode()
-        # Add this file name to a list.
-        dir_list.append(file_name)
+def list_files(connection, prefix='', pattern=None, details=False):
+    # Yield every file on the server whose name starts with prefix and matches the glob pattern,
+    # a page at a time so a large directory never arrives as one huge reply.
+    offset = 0
+    while True:
+        # Send the operation and the options of the listing.
+        options = {'offset': offset, 'limit': LIST_PAGE_SIZE, 'prefix': prefix, 'details': details}
+        if pattern:
+            options['glob'] = pattern
+        connection.sendall(protocol.LIST + protocol.pack_options(options))
+        # Receive the page as a single frame.
+        page = connection.reader.read_options()
+        yield from page['files']
+        offset += len(page['files'])
+        if not page['files'] or offset >= page['total']:
+            return
+
+
+def list_directory_contents(connection, prefix='', pattern=None):
     # Present the contents of the server directory to the user.
     print()
     print('SERVER DIRECTORY CONTAINS: ')
     print()
-    for filename in dir_list:
-        print(filename)
-
-
-def download_file(sock):
-    # Receive the name of the file the user wishes to download from the server.
-    file_name = input('Input the name of the file you wish to download: ')
-    # Get the length of the file name and and send it as a short int in binary form (2 bytes).
-    file_name_length = len(file_name)
-    sock.send(file_name_length.to_bytes(2, 'little'))
-    # Send the encoded file name.
-    sock.send(file_name.encode())
-    # Receive 32 bits as the file size and convert this to an integer.
-    file_size = int.from_bytes(sock.recv(4), 'little', signed=True)
+    for entry in list_files(connection, prefix, pattern, details=True):
+        print(entry['name'] + '  (' + str(entry['size']) + ' bytes)')
+
+
+def download_file(connection, file_name, path=None, progress=False):
+    # Download the server's file file_name, to path if one is given. Returns whether the whole file
+    # arrived intact, with progress printed as it goes if asked for.
+    path = path or file_name
+    # The download is written to a .part file, which is only renamed once it is complete.
+    part_name = path + PART_SUFFIX
+    options = {}
+    if os.path.isfile(part_name):
+        # An interrupted download continues from the bytes we already hold. The part file carries
+        # the modification time of the server's file, so a changed file is started again.
+        stat = os.stat(part_name)
+        options = {'offset': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if connection.compression:
+        # The server only compresses the file if it is worth it.
+        options['compression'] = connection.compression
+    if connection.checksum:
+        # Ask for the hash of the file, to check the file we end up with.
+        options['checksum'] = connection.checksum
+    # Send the operation, the file name (a 2 byte length followed by the name) and the options
+    # of the download all at once.
+    connection.sendall(protocol.DWLD + protocol.pack_name(file_name) + protocol.pack_options(options))
+    # Receive 64 bits as the file size followed by the options of the download.
+    file_size = connection.reader.read_size(signed=True)
+    options = connection.reader.read_options()
     # If the file exists.
     if file_size != -1:
         start_time = time.time()
-        # Open a file and write binary to it.
-        with open(file_name, 'wb') as downloaded_file:
-            num_bytes_received = 0
-            # While we have received less bytes than the size of the file.
-            while num_bytes_received < file_size:
-                # Receive up to 1024 bytes.
-                bytes_received = sock.recv(1024)
-                # Increase the number of bytes received by the number of bytes we received.
-                num_bytes_received += len(bytes_received)
-                # Write the bytes we received to the binary file we opened.
-                downloaded_file.write(bytes_received)
-                # Let the user know what % of the download we have completed.
-                print('DOWNLOAD ' + str(round(num_bytes_received * 100 / file_size, 2)) + '% COMPLETE')
+        # The server tells us where it is continuing from.
+        offset = options.get('offset', 0)
+        num_bytes_received = offset
+        algorithm = options.get('checksum')
+        hasher = integrity.new_hash(algorithm) if algorithm else None
+        meter = Progress('DOWNLOADING ' + file_name, file_size) if progress else None
+        try:
+            # Open the part file and write binary to it from the offset.
+            with open(part_name, 'r+b' if offset else 'wb') as downloaded_file:
+                if hasher is not None and offset:
+                    # The bytes from an earlier attempt are hashed first.
+                    integrity.hash_range(hasher, protocol.file_reader(downloaded_file), 0, offset)
+                downloaded_file.seek(offset)
+                downloaded_file.truncate()
+                codec = options.get('compression')
+                if codec:
+                    def write(data):
+                        if hasher is not None:
+                            hasher.update(data)
+                        downloaded_file.write(data)
+                        if meter is not None:
+                            meter.update(downloaded_file.tell())
+                    # Decompress the file as it arrives, a frame at a time.
+                    num_bytes_received += compression.recv_compressed(
+                        connection.reader, write, file_size - offset, codec)[0]
+                else:
+                    # The file is hashed as it arrives, not read back afterwards.
+                    num_bytes_received += protocol.recv_file(
+                        connection.reader, downloaded_file, file_size - offset, connection.buffer, hasher,
+                        None if meter is None else lambda received: meter.update(offset + received))
+        finally:
+            if meter is not None:
+                meter.finish()
+            # Remember which version of the server's file the part file holds.
+            os.utime(part_name, ns=(options['mtime'], options['mtime']))
+        # The server finishes the download with a trailer.
+        trailer = connection.reader.read_options()
+        if hasher is not None and trailer.get('digest') != hasher.hexdigest():
+            # What we hold is damaged, throw it away so the next attempt starts again.
+            os.remove(part_name)
+            print('DOWNLOAD FAILED: CHECKSUM MISMATCH, ' + str(num_bytes_received) + ' bytes received of ' + str(
+                file_size) + ' bytes.')
+            return False
+        if num_bytes_received == file_size:
+            os.replace(part_name, path)
         process_time = time.time() - start_time
         # Print a string for the user letting them know how the download went.
         print('DOWNLOAD COMPLETE in ' + str(round(float(process_time), 2)) + ' seconds, ' + str(
-            num_bytes_received) + ' bytes received of ' + str(file_size) + ' bytes.')
+            num_bytes_received) + ' bytes received of ' + str(file_size) + ' bytes' + (
+            ', ' + str(trailer.get('wire')) + ' bytes compressed with ' + codec if codec else '') + (
+            ', resumed from ' + str(offset) + ' bytes.' if offset else '.'))
+        return num_bytes_received == file_size
     else:
         # If the file did not exist, let the user know.
         print('FILE STATED DOES NOT EXIST.')
+        return False
+
 
+def report_batch(operation, results, process_time):
+    # Print the files that failed followed by a summary of the batch.
+    failed = [result for result in results if 'error' in result]
+    for result in failed:
+        print(operation + ' FAILED for ' + result['name'] + ': ' + result['error'])
+    print(operation + ' COMPLETE in ' + str(round(float(process_time), 2)) + ' seconds, ' + str(
+        len(results) - len(failed)) + ' of ' + str(len(results)) + ' files transferred.')
 
-def delete_file(sock):
-    # Receive the name of the file the user wishes to delete from the server and encode it.
-    file_name = input('Input the name of the file you wish to delete: ').encode()
-    # Set the file name size to the length of the file name represented as 2 bytes
-    # (as it's a short int).
-    file_name_length = len(file_name).to_bytes(2, 'little')
-    # Send the length of the file name.
-    sock.send(file_name_length)
-    # Send the file name.
-    sock.send(file_name)
+
+def upload_files(connection, file_names):
+    # Only files that exist can be uploaded.
+    for file_name in file_names:
+        if not os.path.isfile(file_name):
+            print('The filename provided is not a valid file: ' + file_name)
+    file_names = [file_name for file_name in file_names if os.path.isfile(file_name)]
+    if 'batch' not in connection.features:
+        # Servers without batch operations get one upload at a time.
+        for file_name in file_names:
+            upload_file(connection, file_name)
+        return
+    # Send the manifest followed straight away by every file back to back, without waiting
+    # for the server to acknowledge each one.
+    manifest = [{'name': file_name, 'size': os.path.getsize(file_name)} for file_name in file_names]
+    connection.sendall(protocol.MUPL + protocol.pack_options({'files': manifest}))
+    # Small files are gathered up and sent together rather than a send each.
+    pending = bytearray()
+    for entry in manifest:
+        with open(entry['name'], 'rb') as f:
+            if entry['size'] < CHUNK_SIZE:
+                data = f.read(entry['size'])
+                # The manifest promised size bytes so a file that shrank is padded.
+                pending += data + bytes(entry['size'] - len(data))
+                if len(pending) >= CHUNK_SIZE:
+                    connection.sendall(pending)
+                    pending.clear()
+            else:
+                if pending:
+                    connection.sendall(pending)
+                    pending.clear()
+                bytes_sent = protocol.send_file(connection.sock, f, entry['size'], connection.buffer)
+                protocol.send_zeros(connection.sock, entry['size'] - bytes_sent, connection.buffer)
+    if pending:
+        connection.sendall(pending)
+    # The server reports how every file went at the end.
+    trailer = connection.reader.read_options()
+    report_batch('BATCH UPLOAD', trailer['results'], trailer['time'])
+
+
+def download_files(connection, file_names):
+    if 'batch' not in connection.features:
+        # Servers without batch operations get one download at a time.
+        for file_name in file_names:
+            download_file(connection, file_name)
+        return
+    # Send the names of every file we want at once.
+    connection.sendall(protocol.MDWL + protocol.pack_options({'files': file_names}))
+    # The server sends the size of every file, then the files back to back.
+    manifest = connection.reader.read_options()['files']
+    # Each file is received into a .part file, which replaces a file we already hold only once the
+    # server has said it was sent whole.
+    part_names = {}
+    trailer = None
+    try:
+        for file_name, entry in zip(file_names, manifest):
+            if entry['size'] != -1:
+                part_names[file_name] = file_name + PART_SUFFIX
+                with open(part_names[file_name], 'wb') as downloaded_file:
+                    if protocol.recv_file(connection.reader, downloaded_file, entry['size'],
+                                          connection.buffer) < entry['size']:
+                        raise ConnectionError('connection closed during the batch download.')
+        # The server reports how every file went at the end.
+        trailer = connection.reader.read_options()
+    finally:
+        # Without the report none of the files can be trusted.
+        failed = set(part_names) if trailer is None else set(
+            result['name'] for result in trailer['results'] if 'error' in result)
+        for file_name, part_name in part_names.items():
+            if file_name in failed:
+                if os.path.exists(part_name):
+                    os.remove(part_name)
+            else:
+                os.replace(part_name, file_name)
+    report_batch('BATCH DOWNLOAD', trailer['results'], trailer['time'])
+
+
+def parallel_worker(address, scheduler, transfer_range):
+    # One connection of a parallel transfer, it transfers ranges until the scheduler has none left.
+    connection = connect(*address)
+    if connection == None:
+        return
+    buffer = bytearray(CHUNK_SIZE)
+    segment = None
+    try:
+        while True:
+            work = scheduler.claim(segment)
+            if work == None:
+                break
+            segment, offset, length = work
+            try:
+                transfer_range(connection, offset, length, buffer)
+            except (socket.error, protocol.ProtocolError):
+                # Give the range back for another connection to transfer and stop using this one.
+                scheduler.failed(segment, offset, length)
+                return
+            except BaseException:
+                # The other connections mustn't wait on a range nobody will finish.
+                scheduler.failed(segment, offset, length)
+                raise
+            scheduler.completed(length)
+        connection.sendall(protocol.QUIT)
+    finally:
+        connection.close()
+
+
+def run_parallel(connection, size, connections, transfer_range):
+    # Transfer size bytes in ranges over several connections to the same server at once.
+    scheduler = SegmentScheduler(size, connections, SEGMENT_WINDOW)
+    address = connection.sock.getpeername()[:2]
+    workers = [threading.Thread(target=parallel_worker, args=(address, scheduler, transfer_range))
+               for _ in range(connections)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return scheduler.transferred
+
+
+def download_file_parallel(connection, file_name, connections=PARALLEL_CONNECTIONS):
+    # Download file_name in ranges over several connections at once. Returns whether the whole
+    # file arrived intact.
+    # Ask for an empty range to learn the size of the file without any of its body, along with
+    # the hash of the whole file to check the ranges against once they are put together.
+    options = {'offset': 0, 'length': 0}
+    if connection.checksum:
+        options['checksum'] = connection.checksum
+    connection.sendall(protocol.RDWL + protocol.pack_name(file_name) + protocol.pack_options(options))
+    file_size = connection.reader.read_size(signed=True)
+    options = connection.reader.read_options()
+    if file_size == -1:
+        # If the file did not exist, let the user know.
+        print('FILE STATED DOES NOT EXIST.')
+        return False
+    if file_size == 0:
+        # There is nothing to split.
+        return download_file(connection, file_name)
+    mtime = options['mtime']
+
+    def download_range(worker_connection, offset, length, buffer):
+        worker_connection.sendall(protocol.RDWL + protocol.pack_name(file_name) +
+                                  protocol.pack_options({'offset': offset, 'length': length}))
+        reply_size = worker_connection.reader.read_size(signed=True)
+        reply = worker_connection.reader.read_options()
+        if reply_size != file_size or reply.get('mtime') != mtime:
+            raise protocol.ProtocolError('the file changed during the download.')
+        if reply['length'] != length:
+            raise protocol.ProtocolError('the server sent the wrong range.')
+        # Each range is written straight to its place in the file.
+        if protocol.recv_file_at(worker_connection.reader, fd, offset, length, buffer) < length:
+            raise ConnectionError('connection closed during the download.')
+
+    start_time = time.time()
+    # The ranges are put together in a .part file, so a failed download never touches a file of
+    # the same name we already hold.
+    part_name = file_name + PART_SUFFIX
+    fd = os.open(part_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Give the file its final size so the ranges can be written in any order.
+        protocol.preallocate(fd, file_size)
+    except OSError as e:
+        os.close(fd)
+        os.remove(part_name)
+        print('PARALLEL DOWNLOAD FAILED: ' + (e.strerror or str(e)) + '.')
+        return False
+    try:
+        num_bytes_received = run_parallel(connection, file_size, connections, download_range)
+    finally:
+        os.close(fd)
+    intact = num_bytes_received == file_size
+    digest = options.get('digest')
+    if intact and connection.checksum and digest is None:
+        # The server worked the hash out while the ranges were sent, wait for it.
+        connection.sendall(protocol.RDWL + protocol.pack_name(file_name) + protocol.pack_options(
+            {'offset': 0, 'length': 0, 'checksum': connection.checksum, 'wait': True}))
+        if connection.reader.read_size(signed=True) != file_size:
+            intact = False
+        digest = connection.reader.read_options().get('digest')
+    if intact and digest:
+        # Read the file back once to check it is the server's file.
+        hasher = integrity.new_hash(connection.checksum)
+        with open(part_name, 'rb') as f:
+            integrity.hash_range(hasher, protocol.file_reader(f), 0, file_size)
+        intact = hasher.hexdigest() == digest
+    process_time = time.time() - start_time
+    # Every range must have arrived for the download to be complete.
+    if intact:
+        # Carry the modification time of the server's file, as a single download does.
+        os.utime(part_name, ns=(mtime, mtime))
+        os.replace(part_name, file_name)
+        print('PARALLEL DOWNLOAD COMPLETE in ' + str(round(process_time, 2)) + ' seconds, ' + str(
+            num_bytes_received) + ' bytes received of ' + str(file_size) + ' bytes over ' + str(
+            connections) + ' connections.')
+    else:
+        os.remove(part_name)
+        print('PARALLEL DOWNLOAD FAILED' + (': CHECKSUM MISMATCH' if num_bytes_received == file_size else '') + ', ' +
+              str(num_bytes_received) + ' bytes received of ' + str(file_size) + ' bytes.')
+    return intact
+
+
+def upload_file_parallel(connection, file_name, connections=PARALLEL_CONNECTIONS):
+    if not os.path.isfile(file_name):
+        # Let the user know the filename wasn't valid.
+        print('The filename provided is not a valid file.')
+        return
+    file_size = os.path.getsize(file_name)
+    if file_size == 0:
+        # There is nothing to split.
+        upload_file(connection, file_name)
+        return
+    # Every segment of this upload carries the same id, the server assembles them out of sight.
+    upload_id = uuid.uuid4().hex
+
+    def upload_range(worker_connection, offset, length, buffer):
+        worker_connection.sendall(protocol.RUPL + protocol.pack_name(file_name) + protocol.pack_options(
+            {'upload': upload_id, 'size': file_size, 'offset': offset, 'length': length}))
+        # Each range is read through its own file object as several connections read at once.
+        with open(file_name, 'rb') as f:
+            f.seek(offset)
+            bytes_sent = protocol.send_file(worker_connection.sock, f, length, buffer)
+        protocol.send_zeros(worker_connection.sock, length - bytes_sent, buffer)
+        reply = worker_connection.reader.read_options()
+        if 'error' in reply or reply['received'] != length:
+            raise protocol.ProtocolError(reply.get('error', 'segment incomplete.'))
+
+    start_time = time.time()
+    options = {'upload': upload_id}
+    with open(file_name, 'rb') as f:
+        # The whole file is hashed while its segments are sent, for the server to check the file it
+        # puts together.
+        background_hash = integrity.BackgroundHash(connection.checksum, protocol.file_reader(f),
+                                                   file_size) if connection.checksum else None
+        run_parallel(connection, file_size, connections, upload_range)
+        if background_hash is not None:
+            options.update({'checksum': connection.checksum, 'digest': background_hash.hexdigest()})
+    # Ask the server to check every segment arrived and move the file into place.
+    connection.sendall(protocol.RFIN + protocol.pack_name(file_name) + protocol.pack_options(options))
+    reply = connection.reader.read_options()
+    process_time = time.time() - start_time
+    if 'error' in reply:
+        print('PARALLEL UPLOAD FAILED: ' + reply['error'])
+    else:
+        print('PARALLEL UPLOAD COMPLETE in ' + str(round(process_time, 2)) + ' seconds, ' + str(
+            reply['received']) + ' bytes transferred of ' + str(file_size) + ' bytes over ' + str(
+            connections) + ' connections.')
+
+
+def server_stats(connection):
+    # Ask the server for its counters, gauges and latency histograms.
+    connection.sendall(protocol.STAT)
+    stats = connection.reader.read_options()
+    print()
+    print('SERVER UP FOR ' + str(round(stats['uptime'])) + ' seconds, ' + str(stats['active_sessions']) +
+          ' sessions active, ' + str(stats['queue_depth']) + ' queued.')
+    print(str(stats['bytes_in']) + ' bytes received, ' + str(stats['bytes_out']) + ' bytes sent.')
+    if stats.get('cache'):
+        print('CACHE: ' + str(stats['cache'].get('hit', 0)) + ' hits, ' + str(stats['cache'].get('miss', 0)) +
+              ' misses, ' + str(stats['cache'].get('eviction', 0)) + ' evictions.')
+    for operation, count in sorted(stats['operations'].items()):
+        total = stats['latency'].get(operation, {}).get('total')
+        print(operation + ': ' + str(count) + ' operations, ' + str(stats['errors'].get(operation, 0)) + ' errors' + (
+            ', ' + str(round(total['sum'] / total['count'], 4)) + ' seconds on average.' if total else '.'))
+    if stats.get('limits'):
+        print_limits(stats['limits'])
+    return stats
+
+
+def print_limits(limits):
+    def rate(value):
+        return str(value) + ' bytes/s' if value else 'none'
+    print('LIMITS: ' + rate(limits['rate']) + ' in total, ' + rate(limits['ip_rate']) + ' per address, ' +
+          rate(limits['session_rate']) + ' per connection, the first ' + str(limits['small_transfer']) +
+          ' bytes of each transfer first.')
+
+
+def server_limits(connection, **limits):
+    # Show the server's bandwidth limits, changing those given first, rates in bytes per second and
+    # 0 for no limit. Returns the limits in force, or None if they couldn't be changed.
+    connection.sendall(protocol.LIMT + protocol.pack_options(limits))
+    reply = connection.reader.read_options()
+    if reply.get('error'):
+        print(reply['error'])
+    print_limits(reply['limits'])
+    return None if reply.get('error') else reply['limits']
+
+
+def input_file_names(message):
+    # Several file names are input separated by commas.
+    return [file_name.strip() for file_name in input(message).split(',') if file_name.strip() != '']
+
+
+def ask_delete_confirmation():
+    return input('Please confirm you wish to delete the file, input Yes to delete, input No to cancel.')
+
+
+def delete_file(connection, file_name, confirm_delete=ask_delete_confirmation):
+    # Returns whether the file was deleted.
+    # Send the operation and the file name (a 2 byte length followed by the name).
+    connection.sendall(protocol.DELF + protocol.pack_name(file_name))
     # Receive 2 bytes from the server and convert them to an int (short int).
-    confirm = int.from_bytes(sock.recv(2), byteorder='little', signed=True)
+    confirm = connection.reader.read_int(2, signed=True)
     # If the int received is -1 let the user know the file does not exist.
     if confirm == -1:
         print('FILE DOES NOT EXIST.')
     elif confirm == 1:
         # If the file exists ask the user to confirm they wish to delete the file.
-        confirm = input('Please confirm you wish to delete the file, input Yes to delete, input No to cancel.')
+        confirm = confirm_delete()
         # If the user inputs 'yes' in any case combination.
         if confirm.upper() == 'YES':
             # Send the confirmation from the user.
-            sock.send(confirm.encode())
+            connection.sendall(protocol.pack_string(confirm))
             # Output a message from the server explaining how the delete went.
-            print('SERVER MESSAGE: ' + sock.recv(1024).decode())
+            message = connection.reader.read_string()
+            print('SERVER MESSAGE: ' + message)
+            return message == 'DELETE SUCCESSFUL.'
         # If the user inputs 'no' in any case combination.
         elif confirm.upper() == 'NO':
             # Send the confirmation to the user.
-            sock.send(confirm.encode())
+            connection.sendall(protocol.pack_string(confirm))
             # Let the user know the delete was abandoned.
             print('Delete abandoned by the user!')
             # Output a message from the server explaining the delete was abandoned.
-            print('SERVER MESSAGE: ' + sock.recv(1024).decode())
+            print('SERVER MESSAGE: ' + connection.reader.read_string())
         else:
             # If the user did not input the Yes/No send 'No' as confirmation to the user
             # to not delete the file.
-            sock.send('No'.encode())
+            connection.sendall(protocol.pack_string('No'))
             # Output then input was not valid so the user abandoned the delete.
             print('Input not valid: Delete abandoned by the user!')
             # Ouput a message similarly from the server.
-            print('SERVER MESSAGE: ' + sock.recv(1024).decode())
+            print('SERVER MESSAGE: ' + connection.reader.read_string())
     else:
         # If the confirm was neither 1 or -1 output that there has been a server error.
         print('SERVER ERROR.')
+    return False
+
+
+class Client:
+    # The server for other programs to use, rather than the prompt. Operations borrow a connection
+    # from a pool of up to pool_size, so up to that many run at once from different threads, and the
+    # async variants run them on a thread so an event loop carries on while a file is transferred.
+    # Raises ConnectionError if the server can't be reached.
+    def __init__(self, host=HOST, port=PORT, codecs=COMPRESSION, checksums=CHECKSUMS, progress=False,
+                 pool_size=1):
+        self.progress = progress
+        self.pool = ConnectionPool(host, port, pool_size, codecs, checksums)
+        # Connect straight away, so an unreachable server is found now.
+        self.pool.release(self.pool.acquire())
+
+    def upload(self, path, name=None):
+        # Upload the local file at path, stored on the server as name, its file name if not given.
+        with self.pool.connection() as connection:
+            return upload_file(connection, path, name or os.path.basename(path), self.progress)
+
+    def download(self, name, path=None):
+        # Download the server's file name, to path if given, otherwise to name in the current directory.
+        with self.pool.connection() as connection:
+            return download_file(connection, name, path, self.progress)
 
+    def list(self, prefix='', pattern=None, details=False):
+        # Every file on the server whose name starts with prefix and matches the glob pattern, with its
+        # size, modification time and hash if details are asked for.
+        with self.pool.connection() as connection:
+            return list(list_files(connection, prefix, pattern, details))
 
-def quit(sock):
-    # Send quit to the server.
-    sock.send('QUIT'.encode())
-    #Close the socket
-    sock.close()
+    def delete(self, name):
+        # Delete the server's file name without asking for confirmation.
+        with self.pool.connection() as connection:
+            return delete_file(connection, name, lambda: 'YES')
+
+    def stats(self):
+        with self.pool.connection() as connection:
+            return server_stats(connection)
+
+    def limits(self, rate=None, ip_rate=None, session_rate=None, small_transfer=None):
+        limits = {'rate': rate, 'ip_rate': ip_rate, 'session_rate': session_rate, 'small_transfer': small_transfer}
+        with self.pool.connection() as connection:
+            return server_limits(connection, **{name: value for name, value in limits.items() if value is not None})
+
+    async def upload_async(self, path, name=None):
+        return await self.run(self.upload, path, name)
+
+    async def download_async(self, name, path=None):
+        return await self.run(self.download, name, path)
+
+    async def list_async(self, prefix='', pattern=None, details=False):
+        return await self.run(self.list, prefix, pattern, details)
+
+    async def delete_async(self, name):
+        return await self.run(self.delete, name)
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def hash_file(path, algorithm):
+    # The hex digest of a local file.
+    hasher = integrity.new_hash(algorithm)
+    with open(path, 'rb') as f:
+        integrity.hash_range(hasher, protocol.file_reader(f), 0, os.fstat(f.fileno()).st_size)
+    return hasher.hexdigest()
+
+
+def file_changed(path, stat, entry):
+    # Whether a local file differs from the server's copy, entry from a detailed listing or None
+    # if the server doesn't have it. The server's modification time is when the file was stored, so
+    # a file of the same size not modified since is taken as unchanged without reading it. One
+    # modified since is compared by hash when the server knows the hash of its copy.
+    if entry is None or entry['size'] != stat.st_size:
+        return True
+    if stat.st_mtime_ns <= entry['mtime']:
+        return False
+    algorithm, _, digest = (entry.get('hash') or '').partition(':')
+    if algorithm in integrity.ALGORITHMS:
+        return hash_file(path, algorithm) != digest
+    return True
+
+
+def sync_directory(directory, host=HOST, port=PORT, prefix='', workers=SYNC_WORKERS, delete=False,
+                   dry_run=False, codecs=COMPRESSION):
+    # Mirror the files in a local directory to the server, each stored as prefix followed by its
+    # name. Only files that are new or changed are uploaded, several at once over a connection each,
+    # and with delete the server's files under the prefix that aren't in the directory are deleted.
+    # Returns whether every transfer succeeded.
+    start_time = time.time()
+    workers = max(1, workers)
+    # Each worker borrows a connection from the pool for every file it transfers.
+    with Client(host, port, codecs, pool_size=workers) as client:
+        remote = dict((entry['name'], entry) for entry in client.list(prefix, details=True))
+        local = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # Hidden files and unfinished downloads are left out.
+                if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith(PART_SUFFIX):
+                    local[prefix + entry.name] = entry
+        uploads = sorted(name for name, entry in local.items()
+                         if file_changed(entry.path, entry.stat(), remote.get(name)))
+        deletes = sorted(name for name in remote if name not in local) if delete else []
+        for name in uploads:
+            print('UPLOAD ' + name)
+        for name in deletes:
+            print('DELETE ' + name)
+        if dry_run or not uploads and not deletes:
+            print('SYNC: ' + str(len(uploads)) + ' files to upload, ' + str(len(deletes)) + ' to delete, ' + str(
+                len(local) - len(uploads)) + ' unchanged.')
+            return True
+
+        def upload(name):
+            try:
+                return client.upload(local[name].path, name)
+            except (socket.error, protocol.ProtocolError) as e:
+                print('UPLOAD FAILED for ' + name + ': ' + str(e))
+                return False
+
+        def remove(name):
+            try:
+                return client.delete(name)
+            except (socket.error, protocol.ProtocolError) as e:
+                print('DELETE FAILED for ' + name + ': ' + str(e))
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            uploaded = list(pool.map(upload, uploads))
+            deleted = list(pool.map(remove, deletes))
+    print('SYNC COMPLETE in ' + str(round(time.time() - start_time, 2)) + ' seconds, ' + str(
+        uploaded.count(True)) + ' of ' + str(len(uploads)) + ' files uploaded, ' + str(
+        deleted.count(True)) + ' of ' + str(len(deletes)) + ' deleted, ' + str(
+        len(local) - len(uploads)) + ' unchanged.')
+    return all(uploaded) and all(deleted)
+
+
+def quit(connection):
+    if connection != None:
+        # Send quit to the server.
+        connection.sendall(protocol.QUIT)
+        #Close the socket
+        connection.close()
     # Output that the quit has been executed and the session is closed.
     print('QUIT EXECUTED: SESSION CLOSED.')
     exit()
 
 
 
-def prompt(sock):
+def prompt(connection, address=(HOST, PORT)):
+    # When the connection was last used, a connection left idle a while is pinged before it is used.
+    last_used = time.monotonic()
     #Repeat this forever.
     while True:
         #Print a blank line.
@@ -199,72 +1086,151 @@ def prompt(sock):
         try:
             try:
                 # Try  and get the operation the user wishes to perform from the user.
-                operation = input('Input the operation you wish to perform (CONN, UPLD, LIST, DWLD, DELF, QUIT): ')
+                operation = input('Input the operation you wish to perform (CONN, UPLD, LIST, DWLD, DELF, MUPL, MDWL, PUPL, PDWL, STAT, QUIT): ')
             except:
                 # This exception seems strange but it deals with the event that the user
                 # closes terminal manually before inputting 'QUIT'.
                 # This causes a signal hang-up which the exception deals with rather than the
                 # server entering a loop.
-                quit(sock)
+                quit(connection)
+            if (connection is not None and operation not in ('CONN', 'QUIT')
+                    and time.monotonic() - last_used > HEARTBEAT_INTERVAL and not ping(connection)):
+                # The server or something between us dropped the idle connection, connect again.
+                print('CONNECTION LOST, RECONNECTING.')
+                connection.close()
+                connection = connect_with_backoff(*address)
+            last_used = time.monotonic()
             # If the length of the operation is 4.
             if len(operation) == 4:
                 if operation == 'CONN':
-                    if sock == None:
-                        # If the socket is none, initiate a TCP connection and return it as socket.
-                        sock = connect()
-                        # Now if the socket is not none (it may still be if the server
-                        # wasn't running).
-                        if sock != None:
-                            # Send the connect operation to the user.
-                            sock.send('CONN'.encode())
-                        else:
+                    if connection == None:
+                        # If there is no connection, initiate a TCP connection.
+                        connection = connect(*address)
+                        # Now if the connection is still none the server wasn't running.
+                        if connection == None:
                             # If the server wasn't running let the user know.
                             print('Server not yet running.')
                     else:
-                        # If the socket wasn't none let the user know the connection is already
+                        # If the connection exists let the user know the connection is already
                         # established.
                         print('CONNECTION ALREADY ESTABLISHED.')
-                # If the operation inputting is not CONN or QUIT or a blank string.
-                if operation != '' and operation != 'CONN' and operation != 'QUIT':
-                    try:
-                        # If the socket is not none.
-                        if sock != None:
-                            # Use the TCP connection to send the operation to the server.
-                            sock.send(operation.encode())
-                        else:
-                            # Otherwise let the user know how to initialise a connection.
-                            print('Initialise a connection before inputting operations.')
-                            print('Input CONN to initialise a connection.')
-                    except socket.error:
-                        # If there was a socket error let the user know and prompt them to re-input.
-                        print('SOCKET ERROR.')
-                        prompt()
-                # If the socket connection has been initialised.
-                if sock != None:
-                    # The below is pretty obvious.
-                    if operation == 'UPLD':
-                        upload_file(sock)
-                    elif operation == 'LIST':
-                        list_directory_contents(sock)
-                    elif operation == 'DWLD':
-                        download_file(sock)
-                    elif operation == 'DELF':
-                        delete_file(sock)
-                    elif operation == 'QUIT':
-                        quit(sock)
-                    elif operation != 'CONN':
-                        # If the operation wasn't one of those stated then let the user know it
-                        # wasn't valid and prompt them to re-input.
-                        print('The operation you inputted is not valid.')
+                elif operation == 'QUIT':
+                    quit(connection)
+                elif connection == None:
+                    # Otherwise let the user know how to initialise a connection.
+                    print('Initialise a connection before inputting operations.')
+                    print('Input CONN to initialise a connection.')
+                # The below is pretty obvious.
+                elif operation == 'UPLD':
+                    upload_file(connection, input('Input the name of the file you wish to upload: '))
+                elif operation == 'LIST':
+                    list_directory_contents(connection)
+                elif operation == 'DWLD':
+                    download_file(connection, input('Input the name of the file you wish to download: '))
+                elif operation == 'DELF':
+                    delete_file(connection, input('Input the name of the file you wish to delete: '))
+                elif operation == 'MUPL':
+                    upload_files(connection, input_file_names(
+                        'Input the names of the files you wish to upload, separated by commas: '))
+                elif operation == 'MDWL':
+                    download_files(connection, input_file_names(
+                        'Input the names of the files you wish to download, separated by commas: '))
+                elif operation == 'STAT':
+                    server_stats(connection)
+                elif operation in ('PUPL', 'PDWL') and 'segmented' not in connection.features:
+                    print('The server does not support parallel transfers.')
+                elif operation == 'PUPL':
+                    upload_file_parallel(connection, input('Input the name of the file you wish to upload: '))
+                elif operation == 'PDWL':
+                    download_file_parallel(connection, input('Input the name of the file you wish to download: '))
+                else:
+                    # If the operation wasn't one of those stated then let the user know it
+                    # wasn't valid and prompt them to re-input.
+                    print('The operation you inputted is not valid.')
             else:
                 # If the length of the operation is not 4 output that the operation
                 # is not valid as all valid operations are 4 letters..
                 print('The operation you inputted is not valid.')
         except KeyboardInterrupt:
             # If the client program was stopped from running perform the quit function.
-            quit(sock)
+            quit(connection)
+        except (socket.error, protocol.ProtocolError):
+            # If the connection failed part way through an operation let the user know and
+            # connect again, if that fails too they can input CONN once the server is back.
+            print('SOCKET ERROR, RECONNECTING.')
+            connection.close()
+            connection = connect_with_backoff(*address)
+            if connection == None:
+                print('Server not reachable, input CONN to connect again.')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='File transfer client, without a command it prompts for operations.')
+    parser.add_argument('--host', default=HOST, help='address of the server')
+    parser.add_argument('--port', type=int, default=PORT, help='port of the server')
+    parser.add_argument('--compression', default=','.join(COMPRESSION),
+                        help='codecs to offer the server for compressing transfers, separated by commas')
+    parser.add_argument('--progress', action='store_true', help='show the progress of each transfer')
+    commands = parser.add_subparsers(dest='command')
+    upload = commands.add_parser('upload', help='upload files')
+    upload.add_argument('files', nargs='+')
+    download = commands.add_parser('download', help='download files to the current directory')
+    download.add_argument('files', nargs='+')
+    listing = commands.add_parser('list', help='list the files on the server')
+    listing.add_argument('--prefix', default='', help='only files whose names start with this')
+    listing.add_argument('--glob', default=None, help='only files whose names match this pattern')
+    delete = commands.add_parser('delete', help='delete files from the server, without asking for confirmation')
+    delete.add_argument('files', nargs='+')
+    commands.add_parser('stats', help="show the server's metrics")
+    limits = commands.add_parser('limits', help="show the server's bandwidth limits, changing those given, "
+                                                 "from the server's own host")
+    limits.add_argument('--rate', type=int, default=None, help='bytes per second for all transfers, 0 for none')
+    limits.add_argument('--ip-rate', type=int, default=None, help='bytes per second for each client address')
+    limits.add_argument('--session-rate', type=int, default=None, help='bytes per second for each connection')
+    limits.add_argument('--small-transfer', type=int, default=None,
+                        help='bytes at the start of each transfer served ahead of bulk transfers')
+    sync = commands.add_parser('sync', help='upload the new and changed files in a directory')
+    sync.add_argument('directory')
+    sync.add_argument('--prefix', default='', help='stored on the server with this before their names')
+    sync.add_argument('--workers', type=int, default=SYNC_WORKERS, help='files uploaded at once')
+    sync.add_argument('--delete', action='store_true',
+                      help="delete the server's files under the prefix that aren't in the directory")
+    sync.add_argument('--dry-run', action='store_true', help='only list what would be uploaded and deleted')
+    return parser.parse_args()
+
+
+def run_command(args):
+    # Carry out a command given on the command line, returns whether it succeeded.
+    codecs = [codec for codec in args.compression.split(',') if codec]
+    if args.command == 'sync':
+        return sync_directory(args.directory, args.host, args.port, args.prefix, args.workers, args.delete,
+                              args.dry_run, codecs)
+    with Client(args.host, args.port, codecs, progress=args.progress) as client:
+        if args.command == 'upload':
+            return all([client.upload(path) for path in args.files])
+        if args.command == 'download':
+            return all([client.download(name) for name in args.files])
+        if args.command == 'delete':
+            return all([client.delete(name) for name in args.files])
+        if args.command == 'list':
+            for entry in client.list(args.prefix, args.glob, details=True):
+                print(entry['name'] + '  (' + str(entry['size']) + ' bytes)')
+        elif args.command == 'stats':
+            client.stats()
+        elif args.command == 'limits':
+            return client.limits(args.rate, args.ip_rate, args.session_rate, args.small_transfer) is not None
+    return True
+
 
 if __name__ == '__main__':
-    #At the start of the program, intialise the socket and perform the prompt operation with it.
-    sock = None
-    prompt(sock)
\ No newline at end of file
+    args = parse_arguments()
+    if args.command is None:
+        #At the start of the program, intialise the connection and perform the prompt operation with it.
+        connection = None
+        prompt(connection, (args.host, args.port))
+    else:
+        try:
+            sys.exit(0 if run_command(args) else 1)
+        except (socket.error, protocol.ProtocolError) as e:
+            print('SOCKET ERROR: ' + str(e))
+            sys.exit(1)
@@ -0,0 +1,139 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+import storage
+
+# The most files kept mapped at once, and the most bytes they may add up to.
+CACHE_FILES = 64
+CACHE_SIZE = 1024 * 1024 * 1024
+# A file is only mapped once it has been downloaded this many times, so a single download of a
+# large file doesn't push out the files everyone is fetching.
+ADMIT_AFTER = 2
+
+
+class CachedFile(storage.StoredFile):
+    # A file mapped into memory, shared by every download of it until it is evicted.
+    def __init__(self, cache, path):
+        self.cache = cache
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            super().__init__(stat.st_size, stat.st_mtime_ns)
+            self.map = mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ)
+        finally:
+            # The mapping keeps the file open itself.
+            os.close(fd)
+        self.view = memoryview(self.map)
+        # The downloads using the mapping, it is only unmapped once they have all finished.
+        self.users = 1
+        # Whether the file is out of the cache, it is until the cache takes it.
+        self.evicted = True
+
+    def send(self, sock, offset, count, buffer):
+        # Send straight from the mapping, a buffer's length at a time, without copying the bytes.
+        count = max(0, min(count, self.size - offset))
+        bytes_sent = 0
+        while bytes_sent < count:
+            n = min(len(buffer), count - bytes_sent)
+            sock.sendall(self.view[offset + bytes_sent:offset + bytes_sent + n])
+            bytes_sent += n
+        return bytes_sent
+
+    def read(self, offset, view):
+        n = max(0, min(len(view), self.size - offset))
+        view[:n] = self.view[offset:offset + n]
+        return n
+
+    def close(self):
+        self.cache.release(self)
+
+    def unmap(self):
+        self.view.release()
+        self.map.close()
+
+
+class FileCache:
+    # Keeps the files downloaded most often mapped into memory, so repeated downloads of the same
+    # file don't open and stat it each time and all share the same pages. The least recently
+    # downloaded files are evicted once there are more than max_files or they add up to more
+    # than max_bytes. Uploads and deletes invalidate a file, and open is given the size and
+    # modification time the index holds, so a file changed outside of the server isn't served stale.
+    def __init__(self, file_store, max_files=CACHE_FILES, max_bytes=CACHE_SIZE, stats=None):
+        self.file_store = file_store
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.lock = threading.Lock()
+        # name -> CachedFile, least recently downloaded first.
+        self.files = OrderedDict()
+        self.size = 0
+        # name -> downloads, of files not cached yet.
+        self.seen = OrderedDict()
+
+    def count(self, event):
+        if self.stats is not None:
+            self.stats.count_cache(event)
+
+    def open(self, file_name, size, mtime_ns):
+        # Return the file to download, mapped if it is downloaded often enough. Raises OSError if
+        # it doesn't exist.
+        with self.lock:
+            cached = self.files.get(file_name)
+            if cached is not None and [cached.size, cached.mtime_ns] == [size, mtime_ns]:
+                self.files.move_to_end(file_name)
+                cached.users += 1
+                self.count('hit')
+                return cached
+            if cached is not None:
+                # The file has changed since it was mapped.
+                self.drop(file_name)
+            downloads = self.seen.pop(file_name, 0) + 1
+            admit = downloads >= ADMIT_AFTER and 0 < size <= self.max_bytes
+            if not admit:
+                self.seen[file_name] = downloads
+                # Only remember so many files that haven't been downloaded enough yet.
+                while len(self.seen) > self.max_files * 4:
+                    self.seen.popitem(last=False)
+        self.count('miss')
+        if not admit:
+            return self.file_store.open(file_name)
+        # Map the file outside of the lock, other downloads needn't wait on the disk.
+        try:
+            cached = CachedFile(self, self.file_store.path(file_name))
+        except ValueError:
+            return self.file_store.open(file_name)
+        with self.lock:
+            if [cached.size, cached.mtime_ns] != [size, mtime_ns] or file_name in self.files:
+                # The index is behind the file, or another download mapped it first. This one is
+                # unmapped once sent.
+                return cached
+            cached.evicted = False
+            self.files[file_name] = cached
+            self.size += cached.size
+            while len(self.files) > self.max_files or self.size > self.max_bytes:
+                self.drop(next(iter(self.files)))
+                self.count('eviction')
+        return cached
+
+    def release(self, cached):
+        # Called when a download of a file has finished with it.
+        with self.lock:
+            cached.users -= 1
+            if cached.users == 0 and cached.evicted:
+                cached.unmap()
+
+    def drop(self, file_name):
+        # Called with the lock held, the mapping goes once the downloads using it have finished.
+        cached = self.files.pop(file_name)
+        self.size -= cached.size
+        cached.evicted = True
+        if cached.users == 0:
+            cached.unmap()
+
+    def invalidate(self, file_name):
+        # Called once a file has been replaced or deleted in storage.
+        with self.lock:
+            if file_name in self.files:
+                self.drop(file_name)
@@ -0,0 +1,194 @@
+import bisect
+import fnmatch
+import sqlite3
+import threading
+import time
+
+# Even when the storage looks unchanged the files are rescanned this often, to pick up files
+# rewritten in place outside of the server, which doesn't change the directory.
+RESCAN_INTERVAL = 60
+# How many files a LIST returns when the client doesn't give a limit.
+DEFAULT_PAGE_SIZE = 1000
+# The most files a LIST returns at once, larger listings are paged through.
+MAX_PAGE_SIZE = 10000
+
+
+class FileIndex:
+    # The name, size, modification time and content hash of every file in storage, kept in memory
+    # so listings don't read the directory and stat every file each time. Uploads and deletes update
+    # the index as they happen, changes made to the storage outside of the server are noticed by the
+    # storage's signature changing, or by the periodic rescan. Rescans run on a thread of their own
+    # and swap the new index in once it is complete, so a request never waits for the storage to be
+    # scanned. With a database path the index is also kept in SQLite, so a restarted server doesn't
+    # need to rescan if nothing has changed.
+    def __init__(self, file_store, database_path=None, rescan_interval=RESCAN_INTERVAL):
+        self.file_store = file_store
+        self.rescan_interval = rescan_interval
+        self.lock = threading.Lock()
+        # name -> [size, mtime, hash], the hash is None until one has been worked out.
+        self.entries = {}
+        # Every name in sorted order, so pages and prefixes are found with a binary search.
+        self.names = []
+        self.signature = None
+        self.scanned_at = 0
+        # The names uploaded, deleted or hashed while a rescan is running, None when none is. Their
+        # entries in the index are newer than whatever the rescan saw.
+        self.touched = None
+        # Set to rescan straight away rather than waiting for the rescan interval.
+        self.wake = threading.Event()
+        self.database = None
+        if database_path is not None:
+            self.database = sqlite3.connect(database_path, check_same_thread=False)
+            self.database.execute('CREATE TABLE IF NOT EXISTS files '
+                                  '(name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)')
+            self.database.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+            self.load()
+        # Until the first scan there is nothing to serve from, so that one is waited for.
+        if self.current_signature() != self.signature or time.time() - self.scanned_at >= self.rescan_interval:
+            self.rescan()
+        threading.Thread(target=self.rescan_forever, name='index-rescan', daemon=True).start()
+
+    def load(self):
+        # Start from the index saved by the last run, it is only trusted if the storage is unchanged.
+        for name, size, mtime, digest in self.database.execute('SELECT name, size, mtime, hash FROM files'):
+            self.entries[name] = [size, mtime, digest]
+        self.names = sorted(self.entries)
+        row = self.database.execute("SELECT value FROM state WHERE key = 'signature'").fetchone()
+        if row is not None:
+            self.signature = int(row[0])
+            self.scanned_at = time.time()
+
+    def save(self, changed=(), removed=()):
+        # Called with the lock held, writes the given entries and the signature to the database.
+        if self.database is None:
+            return
+        with self.database:
+            self.database.executemany('DELETE FROM files WHERE name = ?', ((name,) for name in removed))
+            self.database.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                      ((name,) + tuple(self.entries[name]) for name in changed))
+            self.database.execute("INSERT OR REPLACE INTO state VALUES ('signature', ?)", (str(self.signature),))
+
+    def current_signature(self):
+        try:
+            return self.file_store.signature()
+        except OSError:
+            return None
+
+    def refresh(self):
+        # Called before each lookup, asks for a rescan if the storage has changed since we last
+        # looked. The lookup carries on with the index as it is.
+        if self.current_signature() != self.signature:
+            self.wake.set()
+
+    def rescan_forever(self):
+        while True:
+            # Rescan when asked to, or every rescan interval anyway.
+            self.wake.wait(self.rescan_interval)
+            self.wake.clear()
+            try:
+                self.rescan()
+            except (OSError, sqlite3.Error):
+                # Try again next time round.
+                pass
+
+    def rescan(self):
+        # Scan the whole storage without holding the lock, then swap the result in.
+        signature = self.current_signature()
+        with self.lock:
+            self.touched = set()
+            # Taken in one step, the entries are only replaced under the lock.
+            current = dict(self.entries)
+        entries = {}
+        for name, size, mtime in self.file_store.scan():
+            old = current.get(name)
+            # A file that hasn't changed keeps the hash already worked out for it.
+            digest = old[2] if old is not None and old[:2] == [size, mtime] else None
+            entries[name] = [size, mtime, digest]
+        names = sorted(entries)
+        with self.lock:
+            # Files changed by the server while the scan ran are as the index has them now.
+            for name in self.touched:
+                entry = self.entries.get(name)
+                if entry is None:
+                    if entries.pop(name, None) is not None:
+                        del names[bisect.bisect_left(names, name)]
+                else:
+                    if name not in entries:
+                        bisect.insort(names, name)
+                    entries[name] = entry
+            changed = [name for name, entry in entries.items() if current.get(name) != entry]
+            removed = [name for name in current if name not in entries]
+            self.entries = entries
+            self.names = names
+            if not self.touched:
+                # Otherwise our own changes have already moved the signature on past the scan's.
+                self.signature = signature
+            self.touched = None
+            self.scanned_at = time.time()
+            self.save(changed, removed)
+
+    def update(self, file_name, digest=None):
+        # Called once an upload has been moved into storage.
+        with self.lock:
+            try:
+                size, mtime = self.file_store.stat(file_name)
+            except (OSError, ValueError):
+                self.forget(file_name)
+                return
+            if file_name not in self.entries:
+                bisect.insort(self.names, file_name)
+            self.entries[file_name] = [size, mtime, digest]
+            self.note_own_change(file_name)
+            self.save(changed=[file_name])
+
+    def remove(self, file_name):
+        # Called once a file has been deleted from storage.
+        with self.lock:
+            self.forget(file_name)
+
+    def forget(self, file_name):
+        # Called with the lock held.
+        if self.entries.pop(file_name, None) is not None:
+            del self.names[bisect.bisect_left(self.names, file_name)]
+        self.note_own_change(file_name)
+        self.save(removed=[file_name])
+
+    def note_own_change(self, file_name):
+        # Called with the lock held, our own changes to the storage don't need a rescan.
+        if self.touched is not None:
+            self.touched.add(file_name)
+        try:
+            self.signature = self.file_store.signature()
+        except OSError:
+            pass
+
+    def get(self, file_name):
+        # Return the size, modification time and hash of a file, or None if it isn't in storage.
+        self.refresh()
+        with self.lock:
+            entry = self.entries.get(file_name)
+            return None if entry is None else list(entry)
+
+    def set_hash(self, file_name, size, mtime, digest):
+        # Remember the hash of a file, as long as it is still the version the hash was worked out for.
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry is not None and entry[:2] == [size, mtime]:
+                entry[2] = digest
+                if self.touched is not None:
+                    self.touched.add(file_name)
+                self.save(changed=[file_name])
+
+    def list(self, prefix='', pattern=None, offset=0, limit=DEFAULT_PAGE_SIZE):
+        # Return the number of files matching and the [name, size, mtime, hash] of the page asked for,
+        # in name order.
+        self.refresh()
+        with self.lock:
+            # The names starting with the prefix are next to each other in sorted order.
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_left(self.names, prefix + '\U0010ffff') if prefix else len(self.names)
+            names = self.names[start:end]
+            if pattern:
+                names = fnmatch.filter(names, pattern)
+            page = names[offset:offset + limit]
+            return len(names), [[name] + self.entries[name] for name in page]
@@ -0,0 +1,164 @@
+import bisect
+import os
+import threading
+import time
+from collections import Counter
+
+# The upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# How often the Prometheus text file is rewritten, in seconds.
+DUMP_INTERVAL = 10
+
+
+def label_value(value):
+    # Quote a label value for the Prometheus text format.
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class Histogram:
+    # Counts observations into fixed buckets, cheap enough to update on every operation.
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last bucket counts everything above the largest bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        # [upper bound, observations at or below it] for every bucket, as Prometheus expects.
+        total = 0
+        buckets = []
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            total += count
+            buckets.append([bound, total])
+        return buckets
+
+
+class Metrics:
+    # Counters, gauges and latency histograms for the whole server, shared by every session.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        # Operations performed and those that ended the session with an error, by opcode.
+        self.operations = Counter()
+        self.errors = Counter()
+        # File bytes received from and sent to clients.
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Sessions being served, and those accepted but still waiting for a thread.
+        self.active_sessions = 0
+        self.queue_depth = 0
+        # Downloads served from the file cache ('hit'), from storage ('miss'), and files evicted.
+        self.cache = Counter()
+        # (operation, phase) -> Histogram, phases are 'name' (receiving the name and options),
+        # 'body' (moving the file), 'commit', 'fsync' and 'total'.
+        self.latencies = {}
+
+    def count(self, operation):
+        with self.lock:
+            self.operations[operation] += 1
+
+    def count_error(self, operation):
+        with self.lock:
+            self.errors[operation] += 1
+
+    def count_cache(self, event):
+        with self.lock:
+            self.cache[event] += 1
+
+    def add_bytes(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_in += received
+            self.bytes_out += sent
+
+    def observe(self, operation, phase, seconds):
+        with self.lock:
+            histogram = self.latencies.get((operation, phase))
+            if histogram is None:
+                histogram = self.latencies[(operation, phase)] = Histogram()
+            histogram.observe(seconds)
+
+    def session_queued(self):
+        with self.lock:
+            self.queue_depth += 1
+
+    def session_started(self):
+        with self.lock:
+            self.queue_depth = max(0, self.queue_depth - 1)
+            self.active_sessions += 1
+
+    def session_ended(self):
+        with self.lock:
+            self.active_sessions -= 1
+
+    def snapshot(self):
+        # Everything as a dictionary, sent in reply to STAT.
+        with self.lock:
+            latency = {}
+            for (operation, phase), histogram in sorted(self.latencies.items()):
+                latency.setdefault(operation, {})[phase] = {
+                    'count': histogram.count, 'sum': histogram.sum, 'buckets': histogram.cumulative()}
+            return {
+                'uptime': time.time() - self.started_at,
+                'operations': dict(self.operations),
+                'errors': dict(self.errors),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'active_sessions': self.active_sessions,
+                'queue_depth': self.queue_depth,
+                'cache': dict(self.cache),
+                'latency': latency,
+            }
+
+    def prometheus(self):
+        # Everything in the Prometheus text exposition format.
+        snapshot = self.snapshot()
+        lines = ['# TYPE server_uptime_seconds gauge', 'server_uptime_seconds ' + str(snapshot['uptime'])]
+        for name in ('operations', 'errors'):
+            lines.append('# TYPE server_' + name + '_total counter')
+            for operation, count in sorted(snapshot[name].items()):
+                lines.append('server_' + name + '_total{operation=' + label_value(operation) + '} ' + str(count))
+        lines.append('# TYPE server_bytes_total counter')
+        lines.append('server_bytes_total{direction="in"} ' + str(snapshot['bytes_in']))
+        lines.append('server_bytes_total{direction="out"} ' + str(snapshot['bytes_out']))
+        lines.append('# TYPE server_cache_total counter')
+        for event, count in sorted(snapshot['cache'].items()):
+            lines.append('server_cache_total{event=' + label_value(event) + '} ' + str(count))
+        for name in ('active_sessions', 'queue_depth'):
+            lines.append('# TYPE server_' + name + ' gauge')
+            lines.append('server_' + name + ' ' + str(snapshot[name]))
+        lines.append('# TYPE server_latency_seconds histogram')
+        for operation, phases in snapshot['latency'].items():
+            for phase, histogram in phases.items():
+                labels = 'operation=' + label_value(operation) + ',phase=' + label_value(phase)
+                for bound, count in histogram['buckets']:
+                    lines.append('server_latency_seconds_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(count))
+                lines.append('server_latency_seconds_sum{' + labels + '} ' + str(histogram['sum']))
+                lines.append('server_latency_seconds_count{' + labels + '} ' + str(histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # Written under a temporary name first so a scraper never reads half a file.
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temporary_path, path)
+
+
+def start_dumping(metrics, path, interval=DUMP_INTERVAL):
+    # Rewrite the Prometheus text file every interval seconds for as long as the server runs.
+    def dump_forever():
+        while True:
+            try:
+                metrics.dump(path)
+            except OSError:
+                pass
+            time.sleep(interval)
+    thread = threading.Thread(target=dump_forever, name='metrics', daemon=True)
+    thread.start()
+    return thread
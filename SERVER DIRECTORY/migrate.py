@@ -0,0 +1,99 @@
+import argparse
+import os
+import sys
+import time
+import uuid
+
+# The storage engines use modules shared with the client.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SHARED DIRECTORY'))
+import storage
+
+# How many bytes are copied at once when a file has to be rebuilt rather than moved.
+COPY_BUFFER_SIZE = 1024 * 1024
+# How often progress is printed, in files.
+REPORT_EVERY = 10000
+
+
+def copy_out(source, file_name, path):
+    # Write a file from storage to path, for engines that don't keep files whole.
+    view = memoryview(bytearray(COPY_BUFFER_SIZE))
+    with source.open(file_name) as stored, open(path, 'wb') as f:
+        offset = 0
+        while offset < stored.size:
+            n = stored.read(offset, view)
+            if not n:
+                raise OSError('FILE CHANGED DURING MIGRATION: ' + file_name)
+            f.write(view[:n])
+            offset += n
+
+
+def migrate_file(source, destination, file_name, staging_directory):
+    if isinstance(source, storage.FlatStorage):
+        # Whole files are moved, a rename when both layouts are on the same filesystem. The
+        # chunked engine removes the file once it has chunked it.
+        destination.commit(source.path(file_name), file_name)
+        return
+    staged = os.path.join(staging_directory, uuid.uuid4().hex)
+    try:
+        copy_out(source, file_name, staged)
+        destination.commit(staged, file_name)
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+    source.delete(file_name)
+
+
+def migrate(source, destination, staging_directory):
+    # Move every file from one storage engine to another, returns the names of those that failed.
+    # The server must not be running. An interrupted migration is finished by running it again,
+    # files already moved are no longer in the source.
+    os.makedirs(staging_directory, exist_ok=True)
+    file_names = sorted(source.list_files())
+    failed = []
+    start_time = time.time()
+    for number, file_name in enumerate(file_names, 1):
+        try:
+            migrate_file(source, destination, file_name, staging_directory)
+        except (OSError, ValueError) as e:
+            failed.append(file_name)
+            print('MIGRATION FAILED for ' + file_name + ': ' + str(e))
+        if number % REPORT_EVERY == 0:
+            print(str(number) + ' of ' + str(len(file_names)) + ' files migrated.')
+    if isinstance(source, storage.ShardedStorage):
+        source.prune()
+    print('MIGRATION COMPLETE in ' + str(round(time.time() - start_time, 2)) + ' seconds, ' + str(
+        len(file_names) - len(failed)) + ' of ' + str(len(file_names)) + ' files migrated.')
+    return failed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Move the server's files from one storage layout to another, "
+                                                 'with the server stopped.')
+    parser.add_argument('--from', dest='source', choices=storage.ENGINES, required=True,
+                        help='the layout the files are in now')
+    parser.add_argument('--to', dest='destination', choices=storage.ENGINES, required=True,
+                        help='the layout to move them to')
+    parser.add_argument('--from-roots', nargs='+', default=None,
+                        help='the directories the files are in now, the server files directory if not given')
+    parser.add_argument('--to-roots', nargs='+', default=None,
+                        help='the directories to move them to, the server files directory if not given')
+    args = parser.parse_args()
+    if args.source == args.destination and args.source != 'sharded':
+        parser.error('only sharded storage can be migrated to itself, to spread it over different roots.')
+    return args
+
+
+def main():
+    args = parse_arguments()
+    # The server keeps its files in SERVER FILES under the directory it is run from.
+    server_files = os.getcwd() + '/SERVER FILES'
+    source = storage.create(args.source, args.from_roots or [server_files])
+    destination = storage.create(args.destination, args.to_roots or [server_files])
+    # Files that have to be rebuilt are assembled where the server stages uploads.
+    failed = migrate(source, destination, server_files + '/.staging')
+    print('Remove the --index-db database if the server uses one, it rescans the files on start.')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,200 +1,1244 @@
+import argparse
+import asyncio
+import hashlib
+import ipaddress
+import logging
+import logging.handlers
+import queue
+import shutil
 import socket
+import sys
+import threading
 import time
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+# The protocol module is shared with the client.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SHARED DIRECTORY'))
+import cache
+import chunking
+import compression
+import integrity
+import metadata
+import metrics
+import protocol
+import storage
+import throttle
 
-def wait_for_connection(sock):
+# The address the server binds to unless told otherwise on the command line.
+HOST = '127.0.0.1'
+PORT = 9000
+# How many not yet accepted connections the operating system may queue for us.
+LISTEN_BACKLOG = 128
+# How many clients may be connected at once, further clients wait in the listen backlog.
+MAX_CONNECTIONS = 256
+# 'asyncio' serves many clients at once, 'serial' is the original one client at a time loop.
+WORKER_MODELS = ('asyncio', 'serial')
+# Chunk sizes outside of this range are either syscall bound or waste memory per session.
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Every operation the server knows, anything else a client sends is counted as INVALID.
+OPERATIONS = {'CONN', 'VERS', 'UPLD', 'LIST', 'DWLD', 'DELF', 'MUPL', 'MDWL', 'RDWL', 'RUPL', 'RFIN', 'DDUP',
+              'STAT', 'LIMT', 'PING', 'QUIT'}
+# The optional features this server offers to clients that negotiate a protocol version.
+FEATURES = ['batch', 'segmented', 'ping', 'limits']
+# The compression codecs clients may ask for transfers to use, none with --no-compression.
+COMPRESSION_CODECS = compression.available_codecs()
+# The hash algorithms clients may ask uploads and downloads to be checked with.
+CHECKSUM_ALGORITHMS = integrity.available_algorithms()
+# Operations are logged through a queue by a thread of their own, so a slow console never holds up a transfer.
+logger = logging.getLogger('server')
+# Counters, gauges and latency histograms for every operation, sent in reply to STAT.
+stats = metrics.Metrics()
+# Where the server keeps its files, set up from the command line when the server starts.
+file_store = None
+# The files downloaded most often, kept mapped into memory, or None when there is no cache.
+file_cache = None
+# The name, size and modification time of every file in storage, kept up to date as files change.
+file_index = None
+# Paces transfers to the bandwidth limits, none until some are set.
+scheduler = throttle.Scheduler()
+# Where uploads are assembled inside the server files directory, hidden files are never listed.
+STAGING_DIRECTORY = '.staging'
+# Staged uploads nobody has resumed for this many seconds are removed when the server starts.
+STAGING_EXPIRY = 7 * 24 * 60 * 60
+# When uploads are flushed to disk, 'none' leaves it to the operating system, 'end' flushes each
+# file before it is moved into storage and 'periodic' also flushes every FSYNC_INTERVAL bytes.
+FSYNC_POLICIES = ('none', 'end', 'periodic')
+FSYNC_INTERVAL = 64 * 1024 * 1024
+# Staged uploads record how many of their bytes have arrived in a file with this added to their name,
+# they are preallocated to their full size so their own size doesn't say.
+PROGRESS_SUFFIX = '.received'
+# The segmented uploads in progress, their segments may arrive on any session.
+segmented_uploads = {}
+# Segmented uploads no segment has arrived for in this many seconds are abandoned, and their staged
+# file removed.
+SEGMENTED_UPLOAD_EXPIRY = 24 * 60 * 60
+segmented_uploads_lock = threading.Lock()
+# (file name, algorithm) -> the thread working out the hash of a file for parallel downloads.
+background_digests = {}
+background_digests_lock = threading.Lock()
+# The staged uploads being written to right now, so two clients never append to the same one.
+active_uploads = set()
+active_uploads_lock = threading.Lock()
+
+
+class Session:
+    # The state kept for each connected client.
+    def __init__(self, conn, addr, options):
+        # Everything sent and received goes through the scheduler, which holds transfers back to the
+        # bandwidth limits.
+        self.flow = scheduler.flow(addr)
+        self.conn = scheduler.wrap(conn, self.flow)
+        self.addr = addr
+        self.options = options
+        self.connected_at = time.time()
+        # The number of operations the client has performed this session.
+        self.operations = 0
+        # A buffer reused by every transfer this session rather than allocating one per chunk.
+        self.buffer = bytearray(options.chunk_size)
+        # The buffers of the upload pipeline, allocated the first time the session uploads a large file.
+        self.pipeline_buffers = None
+        # Reads the fields of each operation from the connection.
+        self.reader = protocol.BufferedReader(self.conn)
+        # Clients speak the original protocol until they negotiate a later version.
+        self.version = protocol.LEGACY_VERSION
+        # The operation being performed and when its current phase started, for the latency histograms.
+        self.operation = None
+        self.phase_started = time.perf_counter()
+
+    def is_legacy(self):
+        return self.version == protocol.LEGACY_VERSION
+
+    def get_pipeline_buffers(self):
+        if self.pipeline_buffers is None:
+            self.pipeline_buffers = [self.buffer] + [bytearray(len(self.buffer))
+                                                     for _ in range(self.options.pipeline_depth - 1)]
+        return self.pipeline_buffers
+
+    def end_phase(self, phase):
+        # Record how long a phase of the current operation took, the next phase starts now.
+        now = time.perf_counter()
+        stats.observe(self.operation, phase, now - self.phase_started)
+        self.phase_started = now
+
+
+def serve_session(session):
+    stats.session_started()
+    try:
+        # Receive a 4 byte request from the client and decode it.
+        request = session.reader.read_opcode()
+        # If the request was 'CONN' output the connection ip and wait for an operation.
+        if request == 'CONN':
+            logger.info('SERVER: CLIENT connected ip:<' + str(session.addr) + '>')
+            wait_for_operation(session)
+        else:
+            # Otherwise output yet to connect.
+            logger.warning('SERVER: client yet to connect.')
+    except (OSError, UnicodeDecodeError, ValueError, protocol.ProtocolError):
+        # A client going away mid operation only ends its own session.
+        if session.operation is not None:
+            stats.count_error(session.operation)
+        logger.info('SERVER: CLIENT disconnected ip:<' + str(session.addr) + '>')
+    except Exception:
+        # A bug met serving one client only costs that client its connection, the server carries on.
+        if session.operation is not None:
+            stats.count_error(session.operation)
+        logger.exception('SERVER: ERROR serving ip:<' + str(session.addr) + '>, connection closed.')
+    finally:
+        session.conn.close()
+        session.flow.close()
+        stats.session_ended()
+
+
+async def handle_connection(session, executor, slots):
+    loop = asyncio.get_running_loop()
+    try:
+        # The session uses blocking socket and disk I/O so it runs on the thread pool,
+        # leaving the event loop free to accept other clients.
+        await loop.run_in_executor(executor, serve_session, session)
+    finally:
+        # Free the slot so another client can be accepted.
+        slots.release()
+
+
+async def accept_connections(sock, options):
+    loop = asyncio.get_running_loop()
+    # One thread per connected client, so a slow client never blocks any other.
+    executor = ThreadPoolExecutor(max_workers=options.max_connections, thread_name_prefix='session')
+    # Limits the number of clients connected at once.
+    slots = asyncio.Semaphore(options.max_connections)
+    # Keep a reference to the running sessions so they are not garbage collected.
+    sessions = set()
+    sock.setblocking(False)
+    logger.info('SERVER: waiting for connections.')
+    try:
+        while True:
+            # Wait for a free slot before accepting, while full clients queue in the backlog.
+            await slots.acquire()
+            conn, addr = await loop.sock_accept(sock)
+            # Sessions are served on the thread pool with ordinary blocking sockets.
+            conn.setblocking(True)
+            protocol.tune_socket(conn, options.send_buffer, options.receive_buffer)
+            stats.session_queued()
+            task = loop.create_task(handle_connection(Session(conn, addr, options), executor, slots))
+            sessions.add(task)
+            task.add_done_callback(sessions.discard)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def wait_for_connection(sock, options):
     # Repeat this.
     while True:
         # Server side output that the servers waiting for a connection.
-        print('SERVER: waiting for connection.')
+        logger.debug('SERVER: waiting for connection.')
         # Gets new socket object conn to send and receive data,
         # addr the address bound to the socket on the client side.
         conn, addr = sock.accept()
-        # Receive a 4 byte request from the client and decode it.
-        request = conn.recv(4).decode()
-        # If the request was 'CONN' output the conenction ip and wait for an operation.
-        if request == 'CONN':
-            print('SERVER: CLIENT connected ip:<' + str(addr) + '>')
-            wait_for_operation(conn, sock)
-        else:
-            # Otherwise output yet to connect, note there is no timeout here.
-            print('SERVER: client yet to connect.')
+        protocol.tune_socket(conn, options.send_buffer, options.receive_buffer)
+        # Serve this client until it quits, note there is no timeout here.
+        serve_session(Session(conn, addr, options))
+
+
+def server_files_directory():
+    # The server files directory, next to wherever the server is run from.
+    return os.getcwd() + '/SERVER FILES'
+
+
+def server_file_path(file_name):
+    # The path of a file in the server files directory.
+    return server_files_directory() + '/' + file_name
+
+
+def staging_path(upload_id):
+    # The path an upload is assembled at until every byte has arrived, readers never see
+    # a half written file as it is only then moved into place.
+    return server_file_path(STAGING_DIRECTORY + '/' + upload_id)
+
+
+def resumable_upload_id(file_name, resume):
+    # The same file uploaded again, with the same size, modification time and fingerprint of its
+    # content, stages to the same place and so continues where the last attempt stopped. A changed
+    # file starts afresh.
+    key = '\0'.join([file_name, str(resume.get('size')), str(resume.get('mtime')), str(resume.get('fingerprint'))])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def progress_path(upload_id):
+    return staging_path(upload_id) + PROGRESS_SUFFIX
+
+
+def staged_bytes(upload_id):
+    # How many bytes of a staged upload have arrived so far.
+    try:
+        with open(progress_path(upload_id)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        pass
+    # Uploads staged before progress was recorded were never preallocated.
+    try:
+        return os.path.getsize(staging_path(upload_id))
+    except OSError:
+        return 0
+
+
+def save_progress(upload_id, received):
+    # Written under a temporary name first, a half written count would resume from the wrong place.
+    temporary_path = progress_path(upload_id) + '.' + uuid.uuid4().hex
+    with open(temporary_path, 'w') as f:
+        f.write(str(received))
+    os.replace(temporary_path, progress_path(upload_id))
+
+
+def reserve_staged(upload_id, offset, size, resume):
+    # Give a staged upload its final size, raises OSError when the disk can't hold it.
+    with open(staging_path(upload_id), 'r+b' if offset else 'wb') as f:
+        if resume:
+            # Record how much has arrived before preallocating, the file's size no longer says.
+            save_progress(upload_id, offset)
+        protocol.preallocate(f.fileno(), size)
+
+
+def remove_staged(upload_id):
+    for path in (staging_path(upload_id), progress_path(upload_id)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def open_stored(file_name):
+    # Open a file in storage to download it, from the cache when there is one. Raises OSError if
+    # the file doesn't exist.
+    if file_cache is None:
+        return file_store.open(file_name)
+    # The index says which version of the file the cache should hold, without a stat of its own.
+    entry = file_index.get(file_name)
+    if entry is None:
+        raise FileNotFoundError(file_name)
+    return file_cache.open(file_name, entry[0], entry[1])
+
+
+def indexed_digest(file_name, stored, algorithm):
+    # The hash of the open stored file if the index already knows it for this version of the file.
+    entry = file_index.get(file_name)
+    if (entry is not None and entry[:2] == [stored.size, stored.mtime_ns] and entry[2]
+            and entry[2].startswith(algorithm + ':')):
+        return entry[2].split(':', 1)[1]
+    return None
+
+
+def hash_in_background(file_name, algorithm):
+    # Work out the hash of a stored file on a thread of its own and remember it in the index, returns
+    # the thread. A file already being hashed isn't hashed twice.
+    key = (file_name, algorithm)
+
+    def run():
+        try:
+            with file_store.open(file_name) as stored:
+                if indexed_digest(file_name, stored, algorithm) is None:
+                    hasher = integrity.new_hash(algorithm)
+                    if integrity.hash_range(hasher, stored.read, 0, stored.size) == stored.size:
+                        file_index.set_hash(file_name, stored.size, stored.mtime_ns,
+                                            algorithm + ':' + hasher.hexdigest())
+        except OSError:
+            pass
+        finally:
+            with background_digests_lock:
+                background_digests.pop(key, None)
+
+    with background_digests_lock:
+        thread = background_digests.get(key)
+        if thread is None:
+            thread = background_digests[key] = threading.Thread(target=run, name='hash', daemon=True)
+            thread.start()
+    return thread
+
+
+def file_changed(file_name):
+    # Called once a file has been replaced or deleted in storage, the cache lets go of the old one.
+    if file_cache is not None:
+        file_cache.invalidate(file_name)
+
+
+def clean_staging():
+    # Remove staged uploads that were abandoned long ago.
+    os.makedirs(server_file_path(STAGING_DIRECTORY), exist_ok=True)
+    for upload_id in os.listdir(server_file_path(STAGING_DIRECTORY)):
+        try:
+            if time.time() - os.path.getmtime(staging_path(upload_id)) > STAGING_EXPIRY:
+                if os.path.isdir(staging_path(upload_id)):
+                    # The chunks of a deduplicated upload.
+                    shutil.rmtree(staging_path(upload_id))
+                else:
+                    os.remove(staging_path(upload_id))
+        except OSError:
+            pass
+
+
+def valid_upload_id(upload_id):
+    # Upload ids are chosen by the client and become file names, so only hex digits are allowed.
+    return isinstance(upload_id, str) and 0 < len(upload_id) <= 64 and all(
+        character in '0123456789abcdef' for character in upload_id)
+
+
+def valid_count(value):
+    # Sizes, offsets and lengths come from JSON, so may be anything.
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
 
 
-def upload_file(conn):
-    # Receive the filename length from the user as 2 bytes (short int) and convert them to an int.
-    file_name_length = int.from_bytes(conn.recv(2), byteorder='little')
-    # Receive the filename from the user.
-    file_name = conn.recv(file_name_length).decode()
+def expire_segmented_uploads():
+    # Forget the segmented uploads abandoned by their clients and remove what they staged.
+    now = time.time()
+    with segmented_uploads_lock:
+        expired = [upload_id for upload_id, upload in segmented_uploads.items()
+                   if now - upload['updated'] > SEGMENTED_UPLOAD_EXPIRY]
+        for upload_id in expired:
+            del segmented_uploads[upload_id]
+    for upload_id in expired:
+        remove_staged(upload_id)
+        logger.info('SEGMENTED UPLOAD ABANDONED, ' + upload_id + ' removed.')
+
+
+def valid_chunk(chunk):
+    # Chunk digests become file names and their lengths are read into memory, so both are checked.
+    return (isinstance(chunk, list) and len(chunk) == 2 and isinstance(chunk[0], str) and len(chunk[0]) == 64
+            and all(character in '0123456789abcdef' for character in chunk[0])
+            and isinstance(chunk[1], int) and 0 < chunk[1] <= chunking.MAX_CHUNK_SIZE)
+
+
+def send_message(session, message):
+    # Original clients read messages with a single recv, later versions frame them.
+    if session.is_legacy():
+        session.conn.sendall(message.encode())
+    else:
+        session.conn.sendall(protocol.pack_string(message))
+
+
+def negotiate_version(session):
+    # Receive the 1 byte protocol version the client wants to speak and its options.
+    requested_version = session.reader.read_int(1)
+    options = session.reader.read_options()
+    # Speak the client's version if we know it, otherwise the newest version we know below it.
+    session.version = max([version for version in protocol.SUPPORTED_VERSIONS if version <= requested_version],
+                          default=protocol.LEGACY_VERSION)
+    reply = {'features': FEATURES}
+    if options.get('compression'):
+        # Of the codecs the client offered, those we can use too, in the client's order.
+        reply['compression'] = [codec for codec in options['compression'] if codec in COMPRESSION_CODECS]
+    if options.get('checksums'):
+        # Likewise for the hash algorithms the client can check transfers with.
+        reply['checksums'] = [algorithm for algorithm in options['checksums'] if algorithm in CHECKSUM_ALGORITHMS]
+    session.conn.sendall(protocol.VERS + protocol.pack_int(session.version, 1) + protocol.pack_options(reply))
+    logger.debug('SERVER: speaking protocol version ' + str(session.version) + '.')
+
+
+def upload_file(session):
+    conn = session.conn
+    # Receive the filename, sent as a 2 byte length (short int) followed by the name.
+    file_name = session.reader.read_name()
+    options = {}
+    if not session.is_legacy():
+        # Later versions follow the name with the options of the upload.
+        options = session.reader.read_options()
+    session.end_phase('name')
     # If the conditions are met.
-    if file_name_length > 0 and file_name != '':
-        # Send an acknowledgement that the server is ready to receive data.
-        conn.send('ACK'.encode())
+    if storage.valid_name(file_name):
+        resume = options.get('resume')
+        if not isinstance(resume, dict):
+            resume = None
+        # Resumable uploads stage to a place decided by the file, others to a place of their own.
+        upload_id = resumable_upload_id(file_name, resume) if resume else uuid.uuid4().hex
+        with active_uploads_lock:
+            busy = upload_id in active_uploads
+            active_uploads.add(upload_id)
+        if busy:
+            conn.sendall(protocol.NAK + protocol.pack_options({'error': 'UPLOAD ALREADY IN PROGRESS.'}))
+            logger.warning('UPLOAD ALREADY IN PROGRESS.')
+            return
+        staged = staging_path(upload_id)
         try:
+            # A resumed upload continues from however many bytes were staged last time.
+            offset = staged_bytes(upload_id) if resume and os.path.isfile(staged) else 0
+            # The client may ask to send the file compressed, with a codec we can use.
+            codec = options.get('compression') if options.get('compression') in COMPRESSION_CODECS else None
+            # And ask for the file to be checked against its hash once it has arrived.
+            algorithm = options.get('checksum') if options.get('checksum') in CHECKSUM_ALGORITHMS else None
+            reserved_size = None
+            if resume and valid_count(resume.get('size')) and offset <= resume['size']:
+                # Reserve the disk space for the whole file before accepting it, so a full disk is
+                # refused now rather than found part way through the body.
+                try:
+                    reserve_staged(upload_id, offset, resume['size'], resume)
+                except OSError as e:
+                    conn.sendall(protocol.NAK + protocol.pack_options({'error': e.strerror or str(e)}))
+                    logger.warning('UPLOAD REFUSED: ' + (e.strerror or str(e)))
+                    return
+                reserved_size = resume['size']
+            # Send an acknowledgement that the server is ready to receive data.
+            if session.is_legacy():
+                conn.sendall(protocol.ACK)
+            else:
+                conn.sendall(protocol.ACK + protocol.pack_options(
+                    {'offset': offset, 'compression': codec, 'checksum': algorithm}))
             start_time = time.time()
-            # Receive the file size as a 32 bit value and convert it to an int.
-            file_size = int.from_bytes(conn.recv(4), byteorder='little')
-            # Open a file in the server files directory, and write binary to it.
-            with open(os.getcwd() + '/SERVER FILES/' + file_name, 'wb') as f:
-                num_bytes_received = 0
-                # While we have not received as many bytes as the file size is.
-                while num_bytes_received < file_size:
-                    # Receive up to 1024 bytes.
-                    bytes_received = conn.recv(1024)
-                    # Increase number of bytes received by the number we just received.
-                    num_bytes_received += len(bytes_received)
-                    # Write the bytes received to the new file.
-                    f.write(bytes_received)
+            # Receive the file size, 32 bits in the original protocol and 64 bits since.
+            file_size = session.reader.read_size(session.version)
+            if offset > file_size:
+                offset = 0
+            hasher = integrity.new_hash(algorithm) if algorithm else None
+            fsync = session.options.fsync
+            if reserved_size != file_size:
+                # The space wasn't reserved for this size before the acknowledgement, without it
+                # there is nowhere to put the body.
+                try:
+                    reserve_staged(upload_id, offset, file_size, resume)
+                except OSError as e:
+                    raise protocol.ProtocolError('no space for the upload, ' + (e.strerror or str(e)) + '.')
+            # Open the staged file, which has its final size, and write binary to it from the offset.
+            with open(staged, 'r+b') as f:
+                if hasher is not None and offset:
+                    # The bytes staged by an earlier attempt are hashed first.
+                    integrity.hash_range(hasher, protocol.file_reader(f), 0, offset)
+                f.seek(offset)
+                synced = [0]
+
+                def written(count):
+                    # Called on the writer thread, flushes to disk and records progress every
+                    # FSYNC_INTERVAL bytes.
+                    if count - synced[0] >= FSYNC_INTERVAL:
+                        if fsync == 'periodic':
+                            os.fsync(f.fileno())
+                        if resume:
+                            save_progress(upload_id, offset + count)
+                        synced[0] = count
+                if codec:
+                    def write(data):
+                        if hasher is not None:
+                            hasher.update(data)
+                        f.write(data)
+                    # Decompress the file as it arrives, a frame at a time.
+                    bytes_written, bytes_on_wire = compression.recv_compressed(
+                        session.reader, write, file_size - offset, codec)
+                    num_bytes_received = offset + bytes_written
+                elif session.options.pipeline_depth > 1 and file_size - offset > len(session.buffer):
+                    # Receive into one buffer while the last is written to disk, and hash on the way.
+                    num_bytes_received = offset + protocol.recv_file_pipelined(
+                        session.reader, f, file_size - offset, session.get_pipeline_buffers(), hasher, written)
+                    bytes_on_wire = num_bytes_received - offset
+                else:
+                    # The file is hashed as it arrives, not read back afterwards.
+                    num_bytes_received = offset + protocol.recv_file(session.reader, f, file_size - offset,
+                                                                     session.buffer, hasher)
+                    bytes_on_wire = num_bytes_received - offset
+                session.end_phase('body')
+                if num_bytes_received < file_size:
+                    # Keep what arrived for the client to resume from.
+                    f.truncate(num_bytes_received)
+                    if resume:
+                        save_progress(upload_id, num_bytes_received)
+                elif fsync != 'none':
+                    f.flush()
+                    os.fsync(f.fileno())
+                    session.end_phase('fsync')
+            stats.add_bytes(received=bytes_on_wire)
+            digest = None
+            error = None
+            if hasher is not None:
+                # The client follows the body with the hash of the file it sent.
+                digest = hasher.hexdigest()
+                if session.reader.read_options().get('digest') != digest:
+                    error = 'CHECKSUM MISMATCH.'
+                    # What was staged is damaged, the upload must start again.
+                    resume = None
+            if num_bytes_received == file_size and error is None:
+                try:
+                    # Every byte has arrived, move the file into storage in one step.
+                    file_store.commit(staged, file_name)
+                except OSError as e:
+                    error = e.strerror or str(e)
+                else:
+                    file_changed(file_name)
+                    remove_staged(upload_id)
+                    # Remember its hash, so downloads needn't work it out again.
+                    file_index.update(file_name, algorithm + ':' + digest if digest else None)
+                    session.end_phase('commit')
             process_time = time.time() - start_time
-            # Send the number of bytes received to the client as a 32 bit value.
-            conn.send(num_bytes_received.to_bytes(4, 'little'))
-            # Send the time it took to upload to the client.
-            conn.send(str(process_time).encode())
+            # Send the number of bytes received and the time it took to upload to the client.
+            reply = protocol.pack_size(num_bytes_received, session.version)
+            if session.is_legacy():
+                reply += str(process_time).encode()
+            else:
+                trailer = {'time': process_time, 'wire': bytes_on_wire, 'digest': digest}
+                if error is not None:
+                    trailer['error'] = error
+                reply += protocol.pack_options(trailer)
+            conn.sendall(reply)
             # Output a statement saying how the upload went.
-            print('UPLOAD COMPLETE in ' + str(round(float(process_time), 2)) + ' seconds, ' + str(
-                num_bytes_received) + ' bytes received of ' + str(file_size) + ' bytes.')
-        except TypeError:
-            # If there was a type error output the upload failed.
-            print('UPLOAD FAILED')
+            logger.info('UPLOAD ' + ('FAILED: ' + error if error else 'COMPLETE') + ' in ' + str(
+                round(float(process_time), 2)) + ' seconds, ' + str(
+                num_bytes_received) + ' bytes received of ' + str(file_size) + ' bytes' + (
+                ', ' + str(bytes_on_wire) + ' bytes compressed with ' + codec if codec else '') + (
+                ', resumed from ' + str(offset) + ' bytes.' if offset else '.'))
+        finally:
+            # Only resumable uploads keep what they have so far, others are started again.
+            if not resume:
+                remove_staged(upload_id)
+            with active_uploads_lock:
+                active_uploads.discard(upload_id)
     else:
         # If the conditions weren't met let them know the file doesn't exist.
-        print('FILE DOES NOT EXIST.')
-
-
-def list_files(conn):
-    # List the files in the server files directory.
-    dir_list = [file for file in os.listdir(os.getcwd() + '/SERVER FILES')
-                if os.path.isfile(os.getcwd() + '/SERVER FILES' + '/' + file)]
-    # Remove hidden files from the list.
-    dir_list = [file for file in dir_list if not file.startswith('.')]
-    # Send the encoded number of files in the server files directory to the client.
-    dir_list_length = len(dir_list)
-    conn.send(dir_list_length.to_bytes(4, 'little'))
-    # For each file in the server file directory (excluding hidden files).
-    for file_name in dir_list:
-        # Send the length of the filename as 2 bytes (a short int).
-        file_name_length = len(file_name)
-        conn.send(file_name_length.to_bytes(2, 'little'))
-        # Send the filename,
-        conn.send(file_name.encode())
+        if not session.is_legacy():
+            conn.sendall(protocol.NAK + protocol.pack_options({'error': 'FILE NAME NOT VALID.'}))
+        logger.warning('FILE DOES NOT EXIST.')
+
+
+def list_files(session):
+    if session.is_legacy():
+        # List every file in storage from the index, hidden files are never listed.
+        total, entries = file_index.list(limit=sys.maxsize)
+        # Build the number of files followed by each filename as a 2 byte length and the name,
+        # then send it all at once.
+        reply = [len(entries).to_bytes(4, 'little')]
+        reply.extend(protocol.pack_name(entry[0]) for entry in entries)
+        session.conn.sendall(b''.join(reply))
+    else:
+        # Later versions send the options of the listing, which page of the files matching an
+        # optional prefix and glob pattern they want and whether to include sizes and times.
+        options = session.reader.read_options()
+        offset = options.get('offset', 0)
+        limit = options.get('limit', metadata.DEFAULT_PAGE_SIZE)
+        prefix = options.get('prefix', '')
+        pattern = options.get('glob')
+        if (not valid_count(offset) or not valid_count(limit) or not isinstance(prefix, str)
+                or not isinstance(pattern, (str, type(None)))):
+            raise protocol.ProtocolError('listing options not valid.')
+        total, entries = file_index.list(prefix, pattern or None, offset, min(limit, metadata.MAX_PAGE_SIZE))
+        if options.get('details'):
+            # Along with the hash of each file when one is known, "algorithm:hex".
+            files = [{'name': name, 'size': size, 'mtime': mtime, 'hash': digest}
+                     for name, size, mtime, digest in entries]
+        else:
+            files = [entry[0] for entry in entries]
+        # The page is sent as a single frame, along with how many files match in total.
+        session.conn.sendall(protocol.pack_options({'files': files, 'total': total, 'offset': offset}))
     # State the files have been listed.
-    print('FILES LISTED.')
+    logger.info('FILES LISTED.')
 
 
-def download_file(conn):
-    # Receive the file name length from the user as 2 bytes and convert it to a short int.
-    file_name_length = int.from_bytes(conn.recv(2), byteorder='little')
-    # Receive the file name.
-    file_name = conn.recv(file_name_length).decode()
+def download_file(session):
+    conn = session.conn
+    # Receive the file name, sent as a 2 byte length followed by the name.
+    file_name = session.reader.read_name()
+    options = {}
+    if not session.is_legacy():
+        # Later versions follow the name with the options of the download.
+        options = session.reader.read_options()
+    session.end_phase('name')
+    try:
+        # Open the corresponding file in storage.
+        stored = open_stored(file_name)
+    except OSError:
+        stored = None
     # If the file name received corresponds to a file.
-    if os.path.isfile(os.getcwd() + '/SERVER FILES/' + file_name):
+    if stored is not None:
         start_time = time.time()
-        # Get the size of the corresponding file.
-        file_size = os.path.getsize(os.getcwd() + '/SERVER FILES/' + file_name)
-        # Send the file size as a 32 bit value.
-        conn.send(file_size.to_bytes(4, 'little', signed=True))
-        # Open the corresponding file and read its binary.
-        with open(os.getcwd() + '/SERVER FILES/' + file_name, 'rb') as f:
-            bytes_sent = 0
-            # Read up to 1024 bytes.
-            bytes_to_send = f.read(1024)
-            # Send the bytes we read.
-            conn.send(bytes_to_send)
-            # Increase the number of bytes sent by the amount we just sent.
-            bytes_sent += len(bytes_to_send)
-            # While there are still bytes to send repeat the above process.
-            while bytes_sent < file_size:
-                bytes_to_send = f.read(1024)
-                conn.send(bytes_to_send)
-                bytes_sent += len(bytes_to_send)
+        with stored:
+            # Get the size of the corresponding file.
+            file_size = stored.size
+            # A client holding part of the file continues from where it stopped, as long as the
+            # file is the same one it started downloading.
+            offset = options.get('offset', 0)
+            if not valid_count(offset):
+                raise protocol.ProtocolError('download offset not valid.')
+            if offset > file_size or options.get('mtime') != stored.mtime_ns:
+                offset = 0
+            # The client may ask for the file compressed, it is only sent compressed if a quick
+            # look at a few samples of it says compressing is worth the CPU.
+            codec = options.get('compression') if options.get('compression') in COMPRESSION_CODECS else None
+            if codec and not compression.compressible(stored.read, offset, file_size - offset):
+                codec = None
+            # The client may ask for the hash of the whole file, to check what it ends up with.
+            algorithm = options.get('checksum') if options.get('checksum') in CHECKSUM_ALGORITHMS else None
+            digest = None
+            background_hash = None
+            if algorithm:
+                digest = indexed_digest(file_name, stored, algorithm)
+                if digest is None:
+                    # Otherwise it is worked out on another thread while the file is sent.
+                    background_hash = integrity.BackgroundHash(algorithm, stored.read, file_size)
+            # Send the file size, 32 bits in the original protocol and 64 bits since.
+            header = protocol.pack_size(file_size, session.version, signed=True)
+            if not session.is_legacy():
+                header += protocol.pack_options({'offset': offset, 'mtime': stored.mtime_ns, 'compression': codec,
+                                                 'checksum': algorithm})
+            conn.sendall(header)
+            if codec:
+                # Compress the rest of the file as it is read.
+                bytes_read, bytes_on_wire = compression.send_compressed(
+                    conn, stored.read, offset, file_size - offset, session.buffer, codec)
+                bytes_sent = offset + bytes_read
+            else:
+                # Send the rest of the file, zero-copy where the operating system supports it.
+                bytes_sent = offset + stored.send(conn, offset, file_size - offset, session.buffer)
+                bytes_on_wire = bytes_sent - offset
+            if background_hash is not None:
+                digest = background_hash.hexdigest()
+                if digest is not None:
+                    file_index.set_hash(file_name, file_size, stored.mtime_ns, algorithm + ':' + digest)
+        session.end_phase('body')
+        stats.add_bytes(sent=bytes_on_wire)
         process_time = time.time() - start_time
+        if not session.is_legacy():
+            # Later versions finish the download with a trailer, carrying the hash of the file if asked for.
+            conn.sendall(protocol.pack_options({'time': process_time, 'wire': bytes_on_wire, 'digest': digest}))
         # Output a statement evaluating how the download went.
-        print('DOWNLOAD COMPLETE in ' + str(round(float(process_time), 2)) + ' seconds, ' + str(
-            bytes_sent) + ' bytes received of ' + str(file_size) + ' bytes.')
+        logger.info('DOWNLOAD COMPLETE in ' + str(round(float(process_time), 2)) + ' seconds, ' + str(
+            bytes_sent) + ' bytes received of ' + str(file_size) + ' bytes' + (
+            ', ' + str(bytes_on_wire) + ' bytes compressed with ' + codec if codec else '') + (
+            ', resumed from ' + str(offset) + ' bytes.' if offset else '.'))
     else:
         # If there is no corresponding file send a -1 to the client
         # and output that the file doesn't exist.
-        conn.send((-1).to_bytes(4, 'little', signed=True))
-        print('FILE DOES NOT EXIST.')
+        header = protocol.pack_size(-1, session.version, signed=True)
+        if not session.is_legacy():
+            header += protocol.pack_options({'error': 'FILE DOES NOT EXIST.'})
+        conn.sendall(header)
+        logger.warning('FILE DOES NOT EXIST.')
 
 
-def delete_file(conn):
-    # Receive the length of the file name of the file the client wishes to delete.
-    file_name_length = int.from_bytes(conn.recv(2), byteorder='little')
+def delete_file(session):
+    conn = session.conn
     # Receive the file name of the file the client wishes to delete.
-    file_name = conn.recv(file_name_length).decode()
+    file_name = session.reader.read_name()
     # If the file exists.
-    if os.path.isfile(os.getcwd() + '/SERVER FILES/' + file_name):
+    if file_store.exists(file_name):
         # Send a 1 confirming its existence to the user.
-        conn.send((1).to_bytes(2, 'little', signed=True))
+        conn.sendall(protocol.pack_int(1, 2, signed=True))
         # Receive confirmation on whether the user wants to delete the file.
-        confirm = conn.recv(1024).decode()
+        if session.is_legacy():
+            confirm = session.reader.read_some(1024).decode()
+        else:
+            confirm = session.reader.read_string()
         # If they do.
         if confirm.upper() == 'YES':
             try:
                 # Try and delete the file and let the user know this happened.
-                os.remove(os.getcwd() + '/SERVER FILES/' + file_name)
-                conn.send('DELETE SUCCESSFUL.'.encode())
-                print('FILE DELETED.')
+                file_store.delete(file_name)
+                file_changed(file_name)
+                file_index.remove(file_name)
+                send_message(session, 'DELETE SUCCESSFUL.')
+                logger.info('FILE DELETED.')
             except OSError:
                 # If the delete couldn't happen, let the user know.
-                conn.send('DELETE FAILED.'.encode())
-                print('DELETE FAILED.')
+                send_message(session, 'DELETE FAILED.')
+                logger.error('DELETE FAILED.')
         else:
             # If they didn't confirm they wanted to delete, abandon the delete.
-            conn.send('DELETE CANCELLED.'.encode())
-            print('DELETED CANCELLED.')
+            send_message(session, 'DELETE CANCELLED.')
+            logger.info('DELETED CANCELLED.')
     else:
         # If it doesn't exist send a -1 confirming it doesn't exist.
-        conn.send((-1).to_bytes(2, 'little', signed=True))
-        print('FILE DOES NOT EXIST.')
+        conn.sendall(protocol.pack_int(-1, 2, signed=True))
+        logger.warning('FILE DOES NOT EXIST.')
+
+
+def valid_manifest_entry(entry):
+    # Each file of a batch upload is given by its name and the size of the body that follows.
+    return isinstance(entry, dict) and isinstance(entry.get('name'), str) and valid_count(entry.get('size'))
+
+
+def upload_files(session):
+    conn = session.conn
+    # Receive the manifest, the name and size of every file that follows back to back.
+    manifest = session.reader.read_options().get('files')
+    session.end_phase('name')
+    if not isinstance(manifest, list) or not all(valid_manifest_entry(entry) for entry in manifest):
+        # Without every file's size there is no telling where each body ends.
+        raise protocol.ProtocolError('upload manifest not valid.')
+    start_time = time.time()
+    results = []
+    for entry in manifest:
+        file_name = entry['name']
+        file_size = entry['size']
+        result = {'name': file_name}
+        staged = staging_path(uuid.uuid4().hex)
+        try:
+            storage.check_name(file_name)
+            f = open(staged, 'wb')
+        except OSError as e:
+            # The file couldn't be written, so receive and discard its body to stay in step
+            # with the files that follow.
+            protocol.discard_bytes(session.reader, file_size, session.buffer)
+            result['received'] = 0
+            result['error'] = e.strerror or str(e)
+        else:
+            # Write the body to the staging area, moving it into place once it has all arrived.
+            with f:
+                result['received'] = protocol.recv_file(session.reader, f, file_size, session.buffer)
+            try:
+                if result['received'] == file_size:
+                    file_store.commit(staged, file_name)
+                    file_changed(file_name)
+                    file_index.update(file_name)
+                else:
+                    result['error'] = 'UPLOAD INCOMPLETE.'
+            except OSError as e:
+                result['error'] = e.strerror or str(e)
+        if os.path.exists(staged):
+            os.remove(staged)
+        stats.add_bytes(received=result['received'])
+        results.append(result)
+    session.end_phase('body')
+    process_time = time.time() - start_time
+    # Report how each file went once they have all been received.
+    conn.sendall(protocol.pack_options({'results': results, 'time': process_time}))
+    failed = len([result for result in results if 'error' in result])
+    logger.info('BATCH UPLOAD COMPLETE in ' + str(round(process_time, 2)) + ' seconds, ' + str(
+        len(results) - failed) + ' of ' + str(len(results)) + ' files received.')
 
 
-def wait_for_operation(conn, sock):
+def download_files(session):
+    conn = session.conn
+    # Receive the names of the files the client wishes to download.
+    file_names = session.reader.read_options().get('files')
+    session.end_phase('name')
+    if not isinstance(file_names, list) or not all(isinstance(file_name, str) for file_name in file_names):
+        raise protocol.ProtocolError('download names not valid.')
+    start_time = time.time()
+    # Send the manifest first, the size of every file or -1 if it doesn't exist.
+    manifest = []
+    for file_name in file_names:
+        try:
+            file_size = file_store.size(file_name)
+        except OSError:
+            file_size = -1
+        manifest.append({'name': file_name, 'size': file_size})
+    conn.sendall(protocol.pack_options({'files': manifest}))
+    # Then the bodies back to back.
+    results = []
+    for entry in manifest:
+        result = {'name': entry['name']}
+        if entry['size'] == -1:
+            result['error'] = 'FILE DOES NOT EXIST.'
+        else:
+            try:
+                with open_stored(entry['name']) as stored:
+                    bytes_sent = stored.send(conn, 0, min(entry['size'], stored.size), session.buffer)
+            except OSError as e:
+                bytes_sent = 0
+                result['error'] = e.strerror or str(e)
+            if bytes_sent < entry['size']:
+                # The file shrank or vanished since the manifest was sent, pad the body so the
+                # client stays in step and report the file as failed.
+                protocol.send_zeros(conn, entry['size'] - bytes_sent, session.buffer)
+                result.setdefault('error', 'FILE CHANGED DURING DOWNLOAD.')
+            stats.add_bytes(sent=entry['size'])
+        results.append(result)
+    session.end_phase('body')
+    process_time = time.time() - start_time
+    # Report how each file went once they have all been sent.
+    conn.sendall(protocol.pack_options({'results': results, 'time': process_time}))
+    failed = len([result for result in results if 'error' in result])
+    logger.info('BATCH DOWNLOAD COMPLETE in ' + str(round(process_time, 2)) + ' seconds, ' + str(
+        len(results) - failed) + ' of ' + str(len(results)) + ' files sent.')
+
+
+def download_range(session):
+    conn = session.conn
+    # Receive the file name followed by the offset and length of the range wanted.
+    file_name = session.reader.read_name()
+    options = session.reader.read_options()
+    session.end_phase('name')
+    try:
+        stored = open_stored(file_name)
+    except OSError:
+        conn.sendall(protocol.pack_size(-1, signed=True) +
+                     protocol.pack_options({'error': 'FILE DOES NOT EXIST.'}))
+        return
+    with stored:
+        file_size = stored.size
+        # Never send past the end of the file, a length of 0 just asks for the file size.
+        offset = options.get('offset', 0)
+        length = options.get('length', 0)
+        offset = min(max(offset if isinstance(offset, int) else 0, 0), file_size)
+        length = min(max(length if isinstance(length, int) else 0, 0), file_size - offset)
+        reply = {'offset': offset, 'length': length, 'mtime': stored.mtime_ns}
+        algorithm = options.get('checksum') if options.get('checksum') in CHECKSUM_ALGORITHMS else None
+        if algorithm:
+            # The hash of the whole file, for the client to check the ranges it puts together. If
+            # we don't know it yet it is worked out while the ranges are sent, and the client asks
+            # again, waiting for it, once it has them all.
+            digest = indexed_digest(file_name, stored, algorithm)
+            if digest is None:
+                hashing = hash_in_background(file_name, algorithm)
+                if options.get('wait'):
+                    hashing.join()
+                    digest = indexed_digest(file_name, stored, algorithm)
+            reply['digest'] = digest
+        # Send the size of the whole file and the range that follows.
+        conn.sendall(protocol.pack_size(file_size, signed=True) + protocol.pack_options(reply))
+        bytes_sent = stored.send(conn, offset, length, session.buffer)
+        # If the file shrank while we were sending it, pad the range so the client stays in step.
+        protocol.send_zeros(conn, length - bytes_sent, session.buffer)
+    session.end_phase('body')
+    stats.add_bytes(sent=length)
+
+
+def upload_range(session):
+    conn = session.conn
+    # Receive the file name and which segment of which upload follows.
+    file_name = session.reader.read_name()
+    options = session.reader.read_options()
+    session.end_phase('name')
+    upload_id = options.get('upload')
+    file_size = options.get('size', 0)
+    offset = options.get('offset', 0)
+    length = options.get('length', 0)
+    if not valid_count(length):
+        # Without the length of the segment there is no staying in step with the client.
+        conn.sendall(protocol.pack_options({'error': 'UPLOAD NOT VALID.'}))
+        raise protocol.ProtocolError('segment length not valid.')
+    expire_segmented_uploads()
+    error = None
+    if (not storage.valid_name(file_name) or not valid_upload_id(upload_id) or not valid_count(file_size)
+            or not valid_count(offset)):
+        error = 'UPLOAD NOT VALID.'
+    elif offset + length > file_size:
+        error = 'SEGMENT OUTSIDE OF THE FILE.'
+    else:
+        with segmented_uploads_lock:
+            upload = segmented_uploads.setdefault(upload_id, {'name': file_name, 'size': file_size, 'ranges': []})
+            upload['updated'] = time.time()
+        if upload['name'] != file_name or upload['size'] != file_size:
+            error = 'UPLOAD NOT VALID.'
+    if error is not None:
+        # Receive and discard the segment to stay in step with the client.
+        protocol.discard_bytes(session.reader, length, session.buffer)
+        conn.sendall(protocol.pack_options({'error': error}))
+        return
+    fd = os.open(staging_path(upload_id), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        # The first segment to arrive gives the file its final size.
+        if os.fstat(fd).st_size != file_size:
+            protocol.preallocate(fd, file_size)
+    except OSError as e:
+        os.close(fd)
+        # A full disk, the segment is refused and discarded to stay in step with the client.
+        protocol.discard_bytes(session.reader, length, session.buffer)
+        conn.sendall(protocol.pack_options({'error': e.strerror or str(e)}))
+        return
+    try:
+        # Write the segment straight to its place in the file.
+        bytes_received = protocol.recv_file_at(session.reader, fd, offset, length, session.buffer)
+    finally:
+        os.close(fd)
+    session.end_phase('body')
+    stats.add_bytes(received=bytes_received)
+    with segmented_uploads_lock:
+        upload['ranges'].append((offset, offset + bytes_received))
+    conn.sendall(protocol.pack_options({'received': bytes_received}))
+
+
+def finish_upload(session):
+    conn = session.conn
+    # Receive the file name and the upload whose segments have all been sent, along with the hash
+    # of the whole file if the client has one.
+    file_name = session.reader.read_name()
+    options = session.reader.read_options()
+    upload_id = options.get('upload')
+    expire_segmented_uploads()
+    if not valid_upload_id(upload_id):
+        conn.sendall(protocol.pack_options({'error': 'UPLOAD NOT VALID.'}))
+        return
+    with segmented_uploads_lock:
+        upload = segmented_uploads.pop(upload_id, None)
+    if upload is None or upload['name'] != file_name:
+        conn.sendall(protocol.pack_options({'error': 'UPLOAD NOT VALID.'}))
+        return
+    # Check the segments received cover the whole file.
+    covered = 0
+    for start, end in sorted(upload['ranges']):
+        if start > covered:
+            break
+        covered = max(covered, end)
+    if covered < upload['size']:
+        # Keep the upload so the missing segments can still be sent.
+        with segmented_uploads_lock:
+            segmented_uploads[upload_id] = upload
+        conn.sendall(protocol.pack_options({'error': 'UPLOAD INCOMPLETE.', 'received': covered}))
+        logger.warning('SEGMENTED UPLOAD INCOMPLETE, ' + str(covered) + ' bytes received of ' + str(upload['size']) + ' bytes.')
+        return
+    algorithm = options.get('checksum') if options.get('checksum') in CHECKSUM_ALGORITHMS else None
+    digest = None
+    if algorithm:
+        # Check the segments put together make the client's file.
+        hasher = integrity.new_hash(algorithm)
+        with open(staging_path(upload_id), 'rb') as f:
+            integrity.hash_range(hasher, protocol.file_reader(f), 0, upload['size'])
+        digest = hasher.hexdigest()
+        session.end_phase('verify')
+        if options.get('digest') != digest:
+            # What was staged is damaged, the upload must start again.
+            remove_staged(upload_id)
+            conn.sendall(protocol.pack_options({'error': 'CHECKSUM MISMATCH.'}))
+            logger.warning('SEGMENTED UPLOAD FAILED: CHECKSUM MISMATCH.')
+            return
+    # Move the assembled file into storage in one step.
+    try:
+        file_store.commit(staging_path(upload_id), file_name)
+    except OSError as e:
+        remove_staged(upload_id)
+        conn.sendall(protocol.pack_options({'error': e.strerror or str(e)}))
+        return
+    file_changed(file_name)
+    # Remember its hash, so downloads needn't work it out again.
+    file_index.update(file_name, algorithm + ':' + digest if digest else None)
+    session.end_phase('commit')
+    conn.sendall(protocol.pack_options({'received': upload['size']}))
+    logger.info('SEGMENTED UPLOAD COMPLETE, ' + str(upload['size']) + ' bytes received.')
+
+
+def upload_deduplicated(session):
+    conn = session.conn
+    # Receive the file name followed by the size of the file and the digest and length of each
+    # of its chunks.
+    file_name = session.reader.read_name()
+    options = session.reader.read_options()
+    file_size = options.get('size', 0)
+    chunks = options.get('chunks', [])
+    session.end_phase('name')
+    if (not storage.valid_name(file_name) or not isinstance(file_store, storage.ChunkStorage) or not isinstance(chunks, list)
+            or not all(valid_chunk(chunk) for chunk in chunks) or sum(length for digest, length in chunks) != file_size):
+        conn.sendall(protocol.pack_options({'error': 'UPLOAD NOT VALID.'}))
+        logger.warning('UPLOAD NOT VALID.')
+        return
+    # Tell the client which chunks we don't hold, it sends only those, in this order.
+    missing = file_store.missing_chunks([digest for digest, length in chunks])
+    conn.sendall(protocol.pack_options({'missing': missing}))
+    start_time = time.time()
+    lengths = dict((digest, length) for digest, length in chunks)
+    # The chunks received are staged until the manifest is written, a failed upload leaves none.
+    staged_chunks = staging_path(uuid.uuid4().hex)
+    num_bytes_received = 0
+    error = None
+    try:
+        for digest in missing:
+            data = session.reader.read_exact(lengths[digest])
+            num_bytes_received += len(data)
+            # Only keep chunks whose contents match their digest.
+            if chunking.chunk_digest(data) != digest:
+                error = 'CHUNK DOES NOT MATCH ITS DIGEST.'
+            elif error is None:
+                file_store.stage_chunk(staged_chunks, digest, data)
+        session.end_phase('body')
+        stats.add_bytes(received=num_bytes_received)
+        if error is None:
+            try:
+                # The lengths of the chunks we already held are the stored ones, not the client's.
+                received = set(missing)
+                if any(file_store.chunk_length(digest) != length
+                       for digest, length in set(map(tuple, chunks)) if digest not in received):
+                    error = 'CHUNK LENGTHS DO NOT MATCH.'
+            except OSError:
+                # A chunk was removed, along with the last file using it, since it was checked for.
+                error = 'UPLOAD INCOMPLETE.'
+        if error is None:
+            try:
+                # Every chunk is now stored or staged, make the file visible.
+                file_store.write_manifest(file_name, file_size, chunks, staged_chunks)
+                file_changed(file_name)
+                file_index.update(file_name)
+                session.end_phase('commit')
+            except OSError as e:
+                error = e.strerror or str(e)
+    finally:
+        shutil.rmtree(staged_chunks, ignore_errors=True)
+    process_time = time.time() - start_time
+    reply = {'received': num_bytes_received, 'size': file_size, 'time': process_time}
+    if error is not None:
+        reply['error'] = error
+    conn.sendall(protocol.pack_options(reply))
+    logger.info('DEDUPLICATED UPLOAD ' + ('FAILED: ' + error if error else 'COMPLETE') + ' in ' + str(
+        round(process_time, 2)) + ' seconds, ' + str(num_bytes_received) + ' bytes received for ' + str(
+        file_size) + ' bytes.')
+
+
+def send_stats(session):
+    # Reply with every counter, gauge and histogram as a single frame, along with the bandwidth limits.
+    snapshot = stats.snapshot()
+    snapshot['limits'] = scheduler.limits()
+    session.conn.sendall(protocol.pack_options(snapshot))
+
+
+def set_limits(session):
+    # Receive the limits to change, if any, and reply with the limits now in force. Only clients on
+    # the server's own host may change them.
+    options = session.reader.read_options()
+    limits = {name: options[name] for name in throttle.LIMITS if options.get(name) is not None}
+    reply = {}
+    if limits:
+        try:
+            local = ipaddress.ip_address(session.flow.ip).is_loopback
+        except ValueError:
+            local = False
+        if not local:
+            reply['error'] = 'LIMITS CAN ONLY BE CHANGED FROM THE SERVER ITSELF.'
+        else:
+            try:
+                scheduler.set_limits(**limits)
+                logger.info('SERVER: bandwidth limits changed to ' + str(scheduler.limits()) + '.')
+            except ValueError as e:
+                reply['error'] = str(e)
+    reply['limits'] = scheduler.limits()
+    session.conn.sendall(protocol.pack_options(reply))
+
+
+def wait_for_operation(session):
     while True:
         # Repeat the below.
-        print()
         # Wait to receive a 4 byte operation and decode it when it comes.
-        print('SERVER: waiting for an operation from client.')
-        operation = conn.recv(4).decode()
+        logger.debug('SERVER: waiting for an operation from client.')
+        operation = session.reader.read_opcode()
+        if operation and operation not in OPERATIONS:
+            # The client's bytes never become a metrics label of their own.
+            operation = 'INVALID'
+        session.operations += 1
+        session.operation = operation
+        # Operations that move little data are never held back by the bandwidth limits.
+        session.flow.start(operation)
+        session.phase_started = started = time.perf_counter()
         # Below is obvious.
-        if operation == 'CONN':
-            print('SERVER: CONNECTION ESTABLISHED')
+        if operation == '':
+            # An empty receive means the client closed the connection without a QUIT.
+            logger.info('SERVER: CLIENT disconnected ip:<' + str(session.addr) + '>')
+            return
+        elif operation == 'CONN':
+            logger.debug('SERVER: CONNECTION ESTABLISHED')
+        elif operation == 'VERS':
+            negotiate_version(session)
         elif operation == 'UPLD':
-            upload_file(conn)
+            upload_file(session)
         elif operation == 'LIST':
-            list_files(conn)
+            list_files(session)
         elif operation == 'DWLD':
-            download_file(conn)
+            download_file(session)
         elif operation == 'DELF':
-            delete_file(conn)
+            delete_file(session)
+        elif operation == 'MUPL' and not session.is_legacy():
+            upload_files(session)
+        elif operation == 'MDWL' and not session.is_legacy():
+            download_files(session)
+        elif operation == 'RDWL' and not session.is_legacy():
+            download_range(session)
+        elif operation == 'RUPL' and not session.is_legacy():
+            upload_range(session)
+        elif operation == 'RFIN' and not session.is_legacy():
+            finish_upload(session)
+        elif operation == 'DDUP' and not session.is_legacy():
+            upload_deduplicated(session)
+        elif operation == 'STAT' and not session.is_legacy():
+            send_stats(session)
+        elif operation == 'LIMT' and not session.is_legacy():
+            set_limits(session)
+        elif operation == 'PING' and not session.is_legacy():
+            # Keep-alive, answered straight away.
+            session.conn.sendall(protocol.PING)
         elif operation == 'QUIT':
-            # If the operation was quit, excit the while loop and wait for a connection again.
-            conn.close()
+            # If the operation was quit, exit the while loop, the session closes the connection.
             return
         else:
             # If the input wasn't one of the above it wasn't valid.
-            print('NOT A VALID OPERATION.')
+            logger.warning('NOT A VALID OPERATION.')
+            session.operation = operation = 'INVALID'
+        # Count the operation and how long it took from start to finish.
+        stats.count(operation)
+        stats.observe(operation, 'total', time.perf_counter() - started)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='File transfer server.')
+    parser.add_argument('--host', default=HOST, help='address to bind to')
+    parser.add_argument('--port', type=int, default=PORT, help='port to bind to')
+    parser.add_argument('--workers', choices=WORKER_MODELS, default='asyncio',
+                        help='asyncio serves many clients at once, serial serves one at a time')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='maximum number of clients connected at once')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help='number of pending connections queued by the operating system')
+    parser.add_argument('--storage', choices=storage.ENGINES, default='flat',
+                        help='flat stores every file whole in one directory, sharded spreads them over nested '
+                             'directories by the hash of their names, chunked stores each distinct chunk of content once')
+    parser.add_argument('--storage-roots', nargs='+', default=None,
+                        help='directories the sharded engine spreads files over, for example one per disk, '
+                             'the server files directory if not given')
+    parser.add_argument('--index-db', default=None,
+                        help='keep the file index in this SQLite database, outside of the server files directory, '
+                             'so a restarted server need not rescan its files')
+    parser.add_argument('--rescan-interval', type=float, default=metadata.RESCAN_INTERVAL,
+                        help='seconds between rescans of the files for changes made outside of the server')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='never compress transfers, even when clients ask')
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help='the least severe messages logged to the console')
+    parser.add_argument('--metrics-file', default=None,
+                        help='rewrite the metrics to this file in the Prometheus text format as the server runs')
+    parser.add_argument('--metrics-interval', type=float, default=metrics.DUMP_INTERVAL,
+                        help='seconds between rewrites of --metrics-file')
+    parser.add_argument('--cache-files', type=int, default=cache.CACHE_FILES,
+                        help='most files kept mapped into memory for repeated downloads, 0 turns the cache off')
+    parser.add_argument('--cache-size', type=int, default=cache.CACHE_SIZE,
+                        help='most bytes the files kept mapped into memory may add up to')
+    parser.add_argument('--fsync', choices=FSYNC_POLICIES, default='none',
+                        help='none leaves flushing uploads to disk to the operating system, end flushes each upload '
+                             'before storing it, periodic also flushes every ' + str(FSYNC_INTERVAL) + ' bytes')
+    parser.add_argument('--pipeline-depth', type=int, default=protocol.PIPELINE_DEPTH,
+                        help='buffers an upload receives into ahead of the disk, 1 receives and writes in turn')
+    parser.add_argument('--send-buffer', type=int, default=None,
+                        help='SO_SNDBUF of client connections in bytes, left to the operating system if not given')
+    parser.add_argument('--receive-buffer', type=int, default=None,
+                        help='SO_RCVBUF of client connections in bytes, left to the operating system if not given')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='bytes per second shared by every transfer, 0 for no limit')
+    parser.add_argument('--ip-rate-limit', type=int, default=0,
+                        help='bytes per second shared by the transfers from each client address, 0 for no limit')
+    parser.add_argument('--session-rate-limit', type=int, default=0,
+                        help='bytes per second for each connection, 0 for no limit')
+    parser.add_argument('--small-transfer', type=int, default=throttle.SMALL_TRANSFER,
+                        help='bytes at the start of every transfer served ahead of bulk transfers under --rate-limit')
+    parser.add_argument('--chunk-size', type=int, default=protocol.CHUNK_SIZE,
+                        help='bytes moved per read/recv when zero-copy sendfile is not used')
+    args = parser.parse_args()
+    if args.storage_roots and len(args.storage_roots) > 1 and args.storage != 'sharded':
+        parser.error('only --storage sharded spreads files over several --storage-roots.')
+    if not MIN_CHUNK_SIZE <= args.chunk_size <= MAX_CHUNK_SIZE:
+        parser.error('--chunk-size must be between ' + str(MIN_CHUNK_SIZE) + ' and ' +
+                     str(MAX_CHUNK_SIZE) + ' bytes.')
+    if min(args.rate_limit, args.ip_rate_limit, args.session_rate_limit, args.small_transfer) < 0:
+        parser.error('bandwidth limits must not be negative.')
+    return args
+
 
+def set_up_logging(level):
+    # Operations only put their messages on a queue, a listener thread writes them to the console.
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    return listener
 
-def set_up():
+
+def set_up(args):
+    sock = None
+    listener = set_up_logging(args.log_level)
     try:
-        while True:
-            host = '127.0.0.1'
-            port = 9000
-            sock = socket.socket()
-            # Bind the socket to the address above.
-            sock.bind((host, port))
+        sock = socket.socket()
+        # Allow the server to be restarted straight away on the same port.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Bind the socket to the address given.
+        sock.bind((args.host, args.port))
+        # Make sure uploads have somewhere to be staged and clear out abandoned ones.
+        clean_staging()
+        global file_store
+        file_store = storage.create(args.storage, args.storage_roots or [server_files_directory()])
+        global file_index
+        file_index = metadata.FileIndex(file_store, args.index_db, args.rescan_interval)
+        if args.storage != 'chunked' and args.cache_files > 0 and args.cache_size > 0:
+            # Chunked files are spread over many chunks, only whole files are mapped.
+            global file_cache
+            file_cache = cache.FileCache(file_store, args.cache_files, args.cache_size, stats)
+        scheduler.set_limits(args.rate_limit, args.ip_rate_limit, args.session_rate_limit, args.small_transfer)
+        if args.no_compression:
+            COMPRESSION_CODECS.clear()
+        if args.metrics_file:
+            metrics.start_dumping(stats, args.metrics_file, args.metrics_interval)
+        if args.storage == 'chunked':
+            # Clients may send only the chunks we don't already hold.
+            FEATURES.append('dedup')
+        if args.workers == 'serial':
             sock.listen(1)
             # Now we have the server running, wait for a connection from a client.
-            wait_for_connection(sock)
+            wait_for_connection(sock, args)
+        else:
+            sock.listen(args.backlog)
+            # Serve up to max connections clients at once from the event loop.
+            asyncio.run(accept_connections(sock, args))
+    except KeyboardInterrupt:
+        logger.info('SERVER: shutting down.')
     except Exception as e:
-        #If the socket was already bound to the above port then we have a socket error.
-        sock.close()
-        print('SOCKET ERROR.')
+        # If the socket was already bound to the above port then we have a socket error.
+        logger.error('SOCKET ERROR: ' + str(e))
+    finally:
+        if sock is not None:
+            sock.close()
+        # Write out whatever is still queued.
+        listener.stop()
 
 
 if __name__ == '__main__':
     # At the start of the program, call the set up function.
-    set_up()
\ No newline at end of file
+    set_up(parse_arguments())
@@ -0,0 +1,456 @@
+import bisect
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter
+
+import chunking
+import protocol
+
+# The storage engines the server can keep its files in.
+ENGINES = ('flat', 'sharded', 'chunked')
+# The sharded engine nests each file this many directories deep, each named by this many hex digits
+# of the hash of its name, 65536 directories per root holding a few files each even at millions of files.
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+# The longest file name most filesystems allow, in bytes.
+MAX_NAME_LENGTH = 255
+# How many times a chunked upload is stored again when chunks it shares are removed as it is stored.
+COMMIT_ATTEMPTS = 3
+
+
+class InvalidName(OSError):
+    # A file name that can't be stored, raised as an OSError so it fails like a missing file would.
+    def __init__(self, file_name):
+        super().__init__(errno.EINVAL, 'FILE NAME NOT VALID.', file_name)
+
+
+class ChunksMissing(OSError):
+    # A chunk of a file being stored was removed, along with the last file using it, after it was
+    # checked for. Storing the file again stores the chunk again.
+    def __init__(self):
+        super().__init__(errno.ENOENT, 'UPLOAD INCOMPLETE.')
+
+
+def valid_name(file_name):
+    # Names come from clients and become paths, so a name must stay a single file inside storage:
+    # no separators, nothing hidden, which also rules out . and .., and no longer than a name can be.
+    if not isinstance(file_name, str) or file_name == '' or file_name.startswith('.'):
+        return False
+    if any(character in file_name for character in '/\\\0'):
+        return False
+    try:
+        return len(file_name.encode()) <= MAX_NAME_LENGTH
+    except UnicodeEncodeError:
+        return False
+
+
+def check_name(file_name):
+    if not valid_name(file_name):
+        raise InvalidName(file_name)
+    return file_name
+
+
+def move_file(source_path, path):
+    # Move a file into place in one step, copying it first when it is on another filesystem.
+    try:
+        os.replace(source_path, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Copied next to where it goes, so it still appears there in one step.
+        temporary_path = os.path.join(os.path.dirname(path), '.' + uuid.uuid4().hex)
+        try:
+            shutil.copyfile(source_path, temporary_path)
+            os.replace(temporary_path, path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        os.remove(source_path)
+
+
+class StoredFile:
+    # An open file in storage, downloads send it from here.
+    def __init__(self, size, mtime_ns):
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    def send(self, sock, offset, count, buffer):
+        # Send count bytes of the file from offset to sock, returns the number of bytes sent.
+        raise NotImplementedError
+
+    def read(self, offset, view):
+        # Read up to len(view) bytes of the file from offset into view, returns the number read.
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FlatFile(StoredFile):
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        # Sizes come from the open file, so a file replaced while we send it can't mix two versions.
+        stat = os.fstat(self.f.fileno())
+        super().__init__(stat.st_size, stat.st_mtime_ns)
+        self.read_at = protocol.file_reader(self.f)
+
+    def send(self, sock, offset, count, buffer):
+        self.f.seek(offset)
+        # Zero-copy where the operating system supports it.
+        return protocol.send_file(sock, self.f, count, buffer)
+
+    def read(self, offset, view):
+        # Reads don't move the file position, so the file can be hashed while it is being sent.
+        return self.read_at(offset, view)
+
+    def close(self):
+        self.f.close()
+
+
+class FlatStorage:
+    # Every file is stored whole under its own name in the server files directory.
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, file_name):
+        return self.root + '/' + check_name(file_name)
+
+    def exists(self, file_name):
+        return valid_name(file_name) and os.path.isfile(self.path(file_name))
+
+    def list_files(self):
+        # List the files in the server files directory, hidden files are never listed.
+        return [file for file in os.listdir(self.root)
+                if not file.startswith('.') and os.path.isfile(self.path(file))]
+
+    def open(self, file_name):
+        # Raises OSError if the file doesn't exist.
+        if not self.exists(file_name):
+            raise FileNotFoundError(file_name)
+        return FlatFile(self.path(file_name))
+
+    def size(self, file_name):
+        if not self.exists(file_name):
+            raise FileNotFoundError(file_name)
+        return os.path.getsize(self.path(file_name))
+
+    def stat(self, file_name):
+        # Return the size and modification time of a file, raises OSError if it doesn't exist.
+        stat = os.stat(self.path(file_name))
+        return stat.st_size, stat.st_mtime_ns
+
+    def scan(self):
+        # Yield the name, size and modification time of every file, with one directory read.
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.') and entry.is_file():
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime_ns
+
+    def signature(self):
+        # Changes whenever a file is added, removed or renamed in the directory.
+        return os.stat(self.root).st_mtime_ns
+
+    def commit(self, staged_path, file_name):
+        # Move a completely received upload into place in one step.
+        move_file(staged_path, self.path(file_name))
+
+    def delete(self, file_name):
+        os.remove(self.path(file_name))
+
+
+class ShardedStorage(FlatStorage):
+    # Every file is stored whole, SHARD_LEVELS directories deep under one of several roots, chosen
+    # by the hash of its name. No directory grows past a few entries however many files there are,
+    # so opening, storing and deleting a file costs the same at a million files as at ten, and the
+    # roots may be on different disks. Files are only found by name, so changes made outside of the
+    # server are noticed by the index's periodic rescan rather than straight away.
+    def __init__(self, roots):
+        super().__init__(roots[0])
+        self.roots = roots
+        for root in roots:
+            os.makedirs(root, exist_ok=True)
+
+    def path(self, file_name):
+        digest = hashlib.sha256(check_name(file_name).encode()).hexdigest()
+        root = self.roots[int(digest[:8], 16) % len(self.roots)]
+        shards = [digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(SHARD_LEVELS)]
+        return root + '/' + '/'.join(shards) + '/' + file_name
+
+    def shard_directories(self):
+        # Every directory files are stored in, that exists.
+        return [directory for root in self.roots for directory in self.shard_directories_at(root, SHARD_LEVELS)]
+
+    def list_files(self):
+        return [name for name, size, mtime_ns in self.scan()]
+
+    def prune(self):
+        # Remove the shard directories left empty, deepest first. The server leaves them in place to
+        # be used again, this is for once the files have been moved elsewhere.
+        for level in range(SHARD_LEVELS, 0, -1):
+            for root in self.roots:
+                for directory in sorted(self.shard_directories_at(root, level), reverse=True):
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        pass
+
+    def shard_directories_at(self, root, level):
+        directories = [root]
+        for _ in range(level):
+            subdirectories = []
+            for directory in directories:
+                try:
+                    with os.scandir(directory) as entries:
+                        subdirectories.extend(entry.path for entry in entries if len(entry.name) == SHARD_WIDTH
+                                              and not entry.name.startswith('.') and entry.is_dir())
+                except FileNotFoundError:
+                    pass
+            directories = subdirectories
+        return directories
+
+    def scan(self):
+        # Yield the name, size and modification time of every file, reading every shard directory.
+        for directory in self.shard_directories():
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.startswith('.') and entry.is_file():
+                        stat = entry.stat()
+                        yield entry.name, stat.st_size, stat.st_mtime_ns
+
+    def signature(self):
+        # Only changes as shard directories are first made, the files themselves are rescanned
+        # every rescan interval.
+        return sum(os.stat(root).st_mtime_ns for root in self.roots)
+
+    def commit(self, staged_path, file_name):
+        path = self.path(file_name)
+        # Shard directories are made as the first file stored in them arrives.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        move_file(staged_path, path)
+
+
+class ChunkedFile(StoredFile):
+    def __init__(self, store, manifest, mtime_ns):
+        super().__init__(manifest['size'], mtime_ns)
+        self.store = store
+        self.chunks = manifest['chunks']
+        # Where each chunk starts in the file, to find the chunk an offset falls in.
+        self.starts = []
+        position = 0
+        for digest, length in self.chunks:
+            self.starts.append(position)
+            position += length
+
+    def send(self, sock, offset, count, buffer):
+        bytes_sent = 0
+        index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while bytes_sent < count and index < len(self.chunks):
+            digest, length = self.chunks[index]
+            # Send the part of this chunk we need, zero-copy where the operating system supports it.
+            skip = offset + bytes_sent - self.starts[index]
+            wanted = min(length - skip, count - bytes_sent)
+            with open(self.store.chunk_path(digest), 'rb') as f:
+                f.seek(skip)
+                sent = protocol.send_file(sock, f, wanted, buffer)
+            bytes_sent += sent
+            if sent < wanted:
+                break
+            index += 1
+        return bytes_sent
+
+    def read(self, offset, view):
+        # Reads stop at the end of the chunk the offset falls in.
+        index = bisect.bisect_right(self.starts, offset) - 1
+        if index < 0 or offset >= self.size:
+            return 0
+        digest, length = self.chunks[index]
+        with open(self.store.chunk_path(digest), 'rb') as f:
+            f.seek(offset - self.starts[index])
+            return f.readinto(view[:length - (offset - self.starts[index])])
+
+
+class ChunkStorage:
+    # Files are split into content-defined chunks, each distinct chunk is stored once under
+    # .chunks by its SHA-256 and each file is a manifest under .manifests listing its chunks.
+    # Uploading a file that mostly matches one already stored only adds the chunks that differ.
+    def __init__(self, root):
+        self.root = root
+        self.chunks_directory = root + '/.chunks'
+        self.manifests_directory = root + '/.manifests'
+        os.makedirs(self.chunks_directory, exist_ok=True)
+        os.makedirs(self.manifests_directory, exist_ok=True)
+        # How many manifests use each chunk, a chunk is removed when nothing uses it.
+        self.lock = threading.Lock()
+        self.references = Counter()
+        for file_name in self.list_files():
+            try:
+                self.references.update(digest for digest, length in self.read_manifest(file_name)['chunks'])
+            except (OSError, ValueError):
+                pass
+
+    def chunk_path(self, digest):
+        # Chunks are spread over 256 subdirectories by the start of their digest.
+        return self.chunks_directory + '/' + digest[:2] + '/' + digest
+
+    def manifest_path(self, file_name):
+        return self.manifests_directory + '/' + check_name(file_name)
+
+    def read_manifest(self, file_name):
+        with open(self.manifest_path(file_name), 'rb') as f:
+            return json.loads(f.read().decode())
+
+    def has_chunk(self, digest):
+        return os.path.isfile(self.chunk_path(digest))
+
+    def chunk_length(self, digest):
+        # The length of a chunk we hold, raises OSError if we don't.
+        return os.path.getsize(self.chunk_path(digest))
+
+    def missing_chunks(self, digests):
+        # The digests, from those given, of chunks we don't hold yet.
+        return [digest for digest in dict.fromkeys(digests) if not self.has_chunk(digest)]
+
+    def store_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        if os.path.isfile(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name first so a chunk is never seen half written.
+        temporary_path = path + '.' + uuid.uuid4().hex
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+    def stage_chunk(self, directory, digest, data):
+        # Keep a chunk of an upload in a directory of its own until the upload's manifest is
+        # written, so an upload that fails or is abandoned leaves no chunks behind.
+        os.makedirs(directory, exist_ok=True)
+        with open(directory + '/' + digest, 'wb') as f:
+            f.write(data)
+
+    def write_manifest(self, file_name, size, chunks, staged_directory=None):
+        # Make the file visible, as the given [digest, length] chunks which must all be stored or
+        # staged in staged_directory.
+        manifest = json.dumps({'size': size, 'chunks': chunks}, separators=(',', ':')).encode()
+        temporary_path = self.manifests_directory + '/.' + check_name(file_name) + '.' + uuid.uuid4().hex
+        with open(temporary_path, 'wb') as f:
+            f.write(manifest)
+        with self.lock:
+            staged = set(os.listdir(staged_directory)) if staged_directory and os.path.isdir(staged_directory) else set()
+            # A chunk of this file may have been removed since it was checked, along with
+            # the last file that used it.
+            if not all(digest in staged or self.has_chunk(digest) for digest, length in chunks):
+                os.remove(temporary_path)
+                raise ChunksMissing()
+            # The staged chunks join the stored ones with the manifest that uses them.
+            for digest in staged:
+                if not self.has_chunk(digest):
+                    os.makedirs(os.path.dirname(self.chunk_path(digest)), exist_ok=True)
+                    move_file(staged_directory + '/' + digest, self.chunk_path(digest))
+            old_chunks = self.read_manifest(file_name)['chunks'] if self.exists(file_name) else []
+            os.replace(temporary_path, self.manifest_path(file_name))
+            self.references.update(digest for digest, length in chunks)
+            self.release(old_chunks)
+
+    def release(self, chunks):
+        # Called with the lock held, drops a reference to each chunk and removes unused chunks.
+        for digest, length in chunks:
+            self.references[digest] -= 1
+            if self.references[digest] <= 0:
+                del self.references[digest]
+                try:
+                    os.remove(self.chunk_path(digest))
+                except OSError:
+                    pass
+
+    def exists(self, file_name):
+        return valid_name(file_name) and os.path.isfile(self.manifest_path(file_name))
+
+    def list_files(self):
+        return [file for file in os.listdir(self.manifests_directory) if not file.startswith('.')]
+
+    def open(self, file_name):
+        # Raises OSError if the file doesn't exist.
+        if not self.exists(file_name):
+            raise FileNotFoundError(file_name)
+        with open(self.manifest_path(file_name), 'rb') as f:
+            manifest = json.loads(f.read().decode())
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        return ChunkedFile(self, manifest, mtime_ns)
+
+    def size(self, file_name):
+        if not self.exists(file_name):
+            raise FileNotFoundError(file_name)
+        return self.read_manifest(file_name)['size']
+
+    def stat(self, file_name):
+        # Return the size and modification time of a file, raises OSError if it doesn't exist.
+        if not self.exists(file_name):
+            raise FileNotFoundError(file_name)
+        with open(self.manifest_path(file_name), 'rb') as f:
+            size = json.loads(f.read().decode())['size']
+            return size, os.fstat(f.fileno()).st_mtime_ns
+
+    def scan(self):
+        # Yield the name, size and modification time of every file.
+        for file_name in self.list_files():
+            try:
+                size, mtime_ns = self.stat(file_name)
+            except (OSError, ValueError):
+                continue
+            yield file_name, size, mtime_ns
+
+    def signature(self):
+        # Changes whenever a file is added, removed or replaced.
+        return os.stat(self.manifests_directory).st_mtime_ns
+
+    def commit(self, staged_path, file_name, attempts=COMMIT_ATTEMPTS):
+        # Split a completely received upload into chunks, storing those we don't already hold.
+        for attempt in range(attempts):
+            chunks = []
+            size = 0
+            with open(staged_path, 'rb') as f:
+                for chunk in chunking.iter_chunks(f):
+                    digest = chunking.chunk_digest(chunk)
+                    self.store_chunk(digest, chunk)
+                    chunks.append([digest, len(chunk)])
+                    size += len(chunk)
+            try:
+                self.write_manifest(file_name, size, chunks)
+                break
+            except ChunksMissing:
+                # A chunk we found already stored was removed meanwhile, store the file again.
+                if attempt == attempts - 1:
+                    raise
+        os.remove(staged_path)
+
+    def delete(self, file_name):
+        with self.lock:
+            chunks = self.read_manifest(file_name)['chunks']
+            os.remove(self.manifest_path(file_name))
+            self.release(chunks)
+
+
+def create(engine, roots):
+    # Return the storage engine of the given name over the root directories, only the sharded
+    # engine spreads files over more than the first.
+    if isinstance(roots, str):
+        roots = [roots]
+    if engine == 'chunked':
+        return ChunkStorage(roots[0])
+    if engine == 'sharded':
+        return ShardedStorage(roots)
+    return FlatStorage(roots[0])
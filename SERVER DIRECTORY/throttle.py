@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+
+# Paced transfers move this many bytes between waits, small enough that a transfer gives way to
+# others quickly and large enough that pacing costs few extra syscalls.
+QUANTUM = 256 * 1024
+# A bucket holds at most this many seconds of its rate, how far a transfer may run ahead after idling.
+BURST_TIME = 0.1
+# The first bytes of every transfer are served ahead of bulk transfers, so small files finish
+# quickly while large ones are moving.
+SMALL_TRANSFER = 1024 * 1024
+# The shares of the global rate given to the start of a transfer and to the rest of it.
+SMALL_WEIGHT = 8
+BULK_WEIGHT = 1
+# Operations that move little data are never made to wait, their bytes are still counted.
+INTERACTIVE_OPERATIONS = {'CONN', 'VERS', 'LIST', 'DELF', 'STAT', 'PING', 'LIMT', 'RFIN', 'QUIT'}
+# The limits that may be changed while the server runs, rates in bytes per second, 0 for no limit.
+LIMITS = ('rate', 'ip_rate', 'session_rate', 'small_transfer')
+
+
+class TokenBucket:
+    # Allows rate bytes a second on average, in bursts of up to BURST_TIME seconds' worth.
+    # Bytes may be charged before they are allowed, the bucket then owes them and the next
+    # transfer waits until they are paid back.
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self.rate = rate or 0
+        self.burst = max(QUANTUM, self.rate * BURST_TIME)
+
+    def refill(self):
+        # Called with the lock held.
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, n):
+        with self.lock:
+            if self.rate:
+                self.refill()
+                self.tokens -= n
+
+    def throttle(self, n):
+        # Charge n bytes, returns how many seconds to wait before moving any more.
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+    def delay(self, n):
+        # How many seconds until n bytes, or a whole burst if n is larger, are allowed.
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill()
+            needed = min(n, self.burst)
+            return 0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+
+class FairQueue:
+    # Shares the global rate between the transfers waiting on it by weighted fair queueing. Each
+    # quantum a transfer wants is tagged with the virtual time it would finish at if every
+    # waiting transfer moved at its weight's share, and quanta are let through in order of their
+    # tags, so a transfer with twice the weight moves twice as fast and an idle one can't save up
+    # a share to spend later.
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.condition = threading.Condition()
+        # [finish tag, sequence, start tag] of each quantum waiting, the smallest finish tag first.
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+
+    def wait(self, flow, n, weight):
+        with self.condition:
+            start = max(self.virtual_time, flow.finish)
+            flow.finish = start + n / weight
+            entry = [flow.finish, next(self.sequence), start]
+            heapq.heappush(self.waiting, entry)
+            while True:
+                if self.waiting[0] is entry:
+                    # First in line, wait for the bucket. A quantum with a smaller tag arriving
+                    # meanwhile takes our place when we wake.
+                    delay = self.bucket.delay(n)
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.virtual_time = entry[2]
+            self.bucket.charge(n)
+            self.condition.notify_all()
+
+
+class Flow:
+    # One session's traffic, charged to its own bucket, its client address's and the global one.
+    def __init__(self, scheduler, address):
+        self.scheduler = scheduler
+        self.ip = address[0] if isinstance(address, tuple) else str(address)
+        self.bucket = TokenBucket(scheduler.session_rate)
+        self.ip_bucket = scheduler.acquire_ip(self.ip)
+        # The virtual time this session's last quantum finishes at in the fair queue.
+        self.finish = 0.0
+        self.interactive = True
+        # Bytes moved by the current operation.
+        self.moved = 0
+
+    def start(self, operation):
+        # Called as each operation begins, its bytes are paced according to what it is.
+        self.interactive = operation in INTERACTIVE_OPERATIONS
+        self.moved = 0
+
+    def limited(self):
+        scheduler = self.scheduler
+        return bool(scheduler.bucket.rate or scheduler.ip_rate or scheduler.session_rate)
+
+    def pace(self, n):
+        # Called once n more bytes have been sent or received, waits until the session may go on.
+        scheduler = self.scheduler
+        if self.bucket.rate != scheduler.session_rate:
+            self.bucket.set_rate(scheduler.session_rate)
+        self.moved += n
+        if self.interactive:
+            # Counted against everyone's share, but never held up.
+            self.bucket.charge(n)
+            self.ip_bucket.charge(n)
+            scheduler.bucket.charge(n)
+            return
+        delay = max(self.bucket.throttle(n), self.ip_bucket.throttle(n))
+        if delay > 0:
+            time.sleep(delay)
+        if scheduler.bucket.rate:
+            weight = SMALL_WEIGHT if self.moved <= scheduler.small_transfer else BULK_WEIGHT
+            scheduler.queue.wait(self, n, weight)
+
+    def close(self):
+        self.scheduler.release_ip(self.ip)
+
+
+class ThrottledSocket:
+    # Wraps a session's socket so everything sent and received through it is paced by its flow.
+    # With no limits set calls go straight through to the socket.
+    def __init__(self, sock, flow):
+        self.sock = sock
+        self.flow = flow
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data):
+        if not self.flow.limited():
+            return self.sock.sendall(data)
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), QUANTUM):
+            piece = view[start:start + QUANTUM]
+            self.sock.sendall(piece)
+            self.flow.pace(len(piece))
+
+    def sendfile(self, file, offset=0, count=None):
+        if not self.flow.limited():
+            return self.sock.sendfile(file, offset, count)
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        bytes_sent = 0
+        while bytes_sent < count:
+            sent = self.sock.sendfile(file, offset + bytes_sent, min(QUANTUM, count - bytes_sent))
+            if not sent:
+                break
+            bytes_sent += sent
+            self.flow.pace(sent)
+        return bytes_sent
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if not self.flow.limited():
+            return self.sock.recv_into(buffer, nbytes, flags)
+        # Receiving no more than a quantum at once, a paced upload leaves the rest in the socket
+        # buffer and the client's sends slow down to match.
+        view = memoryview(buffer).cast('B')
+        n = self.sock.recv_into(view, min(nbytes or len(view), QUANTUM), flags)
+        self.flow.pace(n)
+        return n
+
+
+class Scheduler:
+    # Holds the global, per client address and per session limits. rate is shared by every
+    # session, ip_rate by the sessions from each client address and session_rate applies to each
+    # session on its own. All of them can be changed while the server runs.
+    def __init__(self, rate=0, ip_rate=0, session_rate=0, small_transfer=SMALL_TRANSFER):
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(rate)
+        self.queue = FairQueue(self.bucket)
+        self.ip_rate = ip_rate or 0
+        self.session_rate = session_rate or 0
+        self.small_transfer = small_transfer
+        # client address -> [bucket, sessions from it].
+        self.ips = {}
+
+    def flow(self, address):
+        return Flow(self, address)
+
+    def wrap(self, sock, flow):
+        return ThrottledSocket(sock, flow)
+
+    def acquire_ip(self, ip):
+        with self.lock:
+            entry = self.ips.get(ip)
+            if entry is None:
+                entry = self.ips[ip] = [TokenBucket(self.ip_rate), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release_ip(self, ip):
+        with self.lock:
+            entry = self.ips.get(ip)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.ips[ip]
+
+    def limits(self):
+        return {'rate': self.bucket.rate, 'ip_rate': self.ip_rate, 'session_rate': self.session_rate,
+                'small_transfer': self.small_transfer}
+
+    def set_limits(self, rate=None, ip_rate=None, session_rate=None, small_transfer=None):
+        # Change any of the limits, None leaves a limit as it is. Raises ValueError on a negative one.
+        for value in (rate, ip_rate, session_rate, small_transfer):
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise ValueError('LIMITS MUST BE WHOLE NUMBERS OF BYTES, 0 FOR NO LIMIT.')
+        with self.lock:
+            if rate is not None:
+                with self.queue.condition:
+                    self.bucket.set_rate(rate)
+                    # Transfers waiting on the old rate look again.
+                    self.queue.condition.notify_all()
+            if ip_rate is not None:
+                self.ip_rate = ip_rate
+                for bucket, _ in self.ips.values():
+                    bucket.set_rate(ip_rate)
+            if session_rate is not None:
+                # Each session's bucket picks this up the next time it is paced.
+                self.session_rate = session_rate
+            if small_transfer is not None:
+                self.small_transfer = small_transfer
@@ -0,0 +1,54 @@
+import hashlib
+
+# Files are cut into chunks wherever the WINDOW bytes before the cut match PATTERN, once each
+# byte is mapped to whether or not it is a marker. Half the byte values are markers, so on varied
+# content a cut comes roughly every 64 KiB. Cuts depend only on the bytes around them, so inserting
+# or removing bytes only changes the chunks nearby and the rest of a slightly changed file dedups
+# against the old one.
+WINDOW = 16
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# How much of a file is read and searched for cuts at once.
+READ_SIZE = 4 * 1024 * 1024
+
+# Maps every byte to 1 if it is a marker and 0 otherwise, (167 * b + 13) % 256 is a permutation
+# of the byte values so exactly 128 of them are markers.
+MARKERS = bytes(1 if (167 * b + 13) % 256 < 128 else 0 for b in range(256))
+# An evenly mixed pattern of markers and non-markers, text never has long runs of either.
+PATTERN = bytes(bin(i).count('1') % 2 for i in range(WINDOW))
+
+
+def chunk_digest(data):
+    # Chunks are stored and looked up by the SHA-256 of their contents.
+    return hashlib.sha256(data).hexdigest()
+
+
+def iter_chunks(f):
+    # Yield the content-defined chunks of the open file f, in order.
+    data = b''
+    eof = False
+    while True:
+        if not eof and len(data) <= MAX_CHUNK_SIZE:
+            block = f.read(READ_SIZE)
+            eof = not block
+            data += block
+            # Searching for cuts is done on the marker bytes with bytes.find, in C, rather
+            # than byte by byte in Python.
+            marks = data.translate(MARKERS)
+        if not data:
+            return
+        position = 0
+        while len(data) - position > MAX_CHUNK_SIZE or (eof and position < len(data)):
+            run = marks.find(PATTERN, position + MIN_CHUNK_SIZE - WINDOW, position + MAX_CHUNK_SIZE)
+            cut = run + WINDOW if run != -1 else min(position + MAX_CHUNK_SIZE, len(data))
+            yield data[position:cut]
+            position = cut
+        # Keep what is left over to be cut along with the next block.
+        data = data[position:]
+        marks = marks[position:]
+
+
+def chunk_file(file_name):
+    # Return the [digest, length] of every chunk of the file.
+    with open(file_name, 'rb') as f:
+        return [[chunk_digest(chunk), len(chunk)] for chunk in iter_chunks(f)]
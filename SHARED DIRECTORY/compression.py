@@ -0,0 +1,173 @@
+import lzma
+import zlib
+
+import protocol
+
+# zstd and lz4 are used when their packages are installed, zlib and lzma always can be.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Files smaller than this are sent as they are, compressing them saves next to nothing.
+MIN_COMPRESSED_SIZE = 4 * 1024
+# Before compressing a file a few samples spread through it are compressed, content that doesn't
+# shrink to PROBE_RATIO of its size, images, video and archives, is sent as it is.
+PROBE_SAMPLES = 4
+PROBE_SAMPLE_SIZE = 64 * 1024
+PROBE_RATIO = 0.9
+# The most bytes one frame of compressed data may decompress to at once, so a small frame can't
+# expand into a huge amount of memory.
+DECOMPRESS_LIMIT = 1024 * 1024
+
+
+class Lz4Compressor:
+    # lz4's frame compressor must be told where the stream begins.
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.started = False
+
+    def begin(self):
+        if self.started:
+            return b''
+        self.started = True
+        return self.compressor.begin()
+
+    def compress(self, data):
+        return self.begin() + self.compressor.compress(data)
+
+    def flush(self):
+        return self.begin() + self.compressor.flush()
+
+
+class ZstdDecompressor:
+    # zstandard's decompressobj can't be asked for a limited amount of output, its stream writer
+    # passes the output on a DECOMPRESS_LIMIT piece at a time as it decompresses.
+    def __init__(self):
+        self.output = None
+        self.writer = zstandard.ZstdDecompressor().stream_writer(self, write_size=DECOMPRESS_LIMIT, closefd=False)
+
+    def write(self, piece):
+        self.output(piece)
+        return len(piece)
+
+    def decompress_into(self, data, write):
+        self.output = write
+        self.writer.write(data)
+
+
+# Each codec's name and how to make its compressor and decompressor, in order of preference.
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = (lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+                      ZstdDecompressor)
+if lz4 is not None:
+    CODECS['lz4'] = (Lz4Compressor, lz4.frame.LZ4FrameDecompressor)
+CODECS['zlib'] = (lambda: zlib.compressobj(3), zlib.decompressobj)
+CODECS['lzma'] = (lambda: lzma.LZMACompressor(preset=1), lzma.LZMADecompressor)
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def choose_codec(offered):
+    # The first of the codecs offered that we can use, or None.
+    for codec in offered or []:
+        if codec in CODECS:
+            return codec
+    return None
+
+
+def compressible(read, offset, count):
+    # Whether count bytes from offset look worth compressing, judged from a few samples
+    # compressed quickly rather than the whole file.
+    if count < MIN_COMPRESSED_SIZE:
+        return False
+    sample = bytearray(min(PROBE_SAMPLE_SIZE, count))
+    step = max(len(sample), count // PROBE_SAMPLES)
+    total = 0
+    compressed = 0
+    for start in range(offset, offset + count - len(sample) + 1, step)[:PROBE_SAMPLES]:
+        n = read(start, memoryview(sample))
+        total += n
+        compressed += len(zlib.compress(sample[:n], 1))
+    return total > 0 and compressed < total * PROBE_RATIO
+
+
+def decompress_into(decompressor, data, write):
+    # Decompress data, passing the output to write no more than DECOMPRESS_LIMIT bytes at a time.
+    if isinstance(decompressor, ZstdDecompressor):
+        # zstd hands over its output itself. Its decompressobj has an unconsumed_tail too, but no
+        # way to limit the output, so it must be told apart before zlib.
+        decompressor.decompress_into(data, write)
+    elif hasattr(decompressor, 'unconsumed_tail'):
+        # zlib keeps the input it hasn't got to yet.
+        write(decompressor.decompress(data, DECOMPRESS_LIMIT))
+        while decompressor.unconsumed_tail:
+            write(decompressor.decompress(decompressor.unconsumed_tail, DECOMPRESS_LIMIT))
+    else:
+        # lzma and lz4 hold on to the input themselves until asked for more output.
+        write(decompressor.decompress(data, DECOMPRESS_LIMIT))
+        while not decompressor.needs_input and not decompressor.eof:
+            write(decompressor.decompress(b'', DECOMPRESS_LIMIT))
+
+
+def send_compressed(sock, read, offset, count, buffer, codec):
+    # Send count bytes from offset, read with read(offset, view), compressed as they are read.
+    # The compressed stream is sent as frames ending with an empty one, returns the number of
+    # bytes read and the number of bytes sent.
+    compressor = CODECS[codec][0]()
+    view = memoryview(buffer)
+    bytes_read = 0
+    bytes_sent = 0
+    while bytes_read < count:
+        n = read(offset + bytes_read, view[:min(len(view), count - bytes_read)])
+        if not n:
+            # The file shrank, the receiver sees the stream end early.
+            break
+        bytes_read += n
+        data = compressor.compress(view[:n])
+        if data:
+            sock.sendall(protocol.pack_frame(data))
+            bytes_sent += len(data)
+    data = compressor.flush()
+    if data:
+        sock.sendall(protocol.pack_frame(data))
+        bytes_sent += len(data)
+    sock.sendall(protocol.pack_int(0, 4))
+    return bytes_read, bytes_sent
+
+
+def recv_compressed(reader, write, count, codec):
+    # Receive a compressed stream of at most count bytes, passing each piece to write as it is
+    # decompressed. Returns the number of bytes decompressed and the number of bytes received.
+    decompressor = CODECS[codec][1]()
+    bytes_written = 0
+    bytes_received = 0
+
+    def write_piece(piece):
+        nonlocal bytes_written
+        bytes_written += len(piece)
+        if bytes_written > count:
+            raise protocol.ProtocolError('compressed body is larger than the file.')
+        if piece:
+            write(piece)
+
+    while True:
+        data = reader.read_frame()
+        if not data:
+            return bytes_written, bytes_received
+        bytes_received += len(data)
+        try:
+            decompress_into(decompressor, data, write_piece)
+        except (OSError, protocol.ProtocolError):
+            # Writing the file failed or the body is too large, not the codec.
+            raise
+        except Exception as e:
+            # Each codec raises its own error on data that isn't a valid stream.
+            raise protocol.ProtocolError('compressed body is not valid: ' + str(e))
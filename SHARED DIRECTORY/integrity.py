@@ -0,0 +1,87 @@
+import hashlib
+import threading
+
+# xxhash is used when its package is installed, BLAKE2 and SHA-256 always can be.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# How many bytes a background hash reads at once.
+HASH_BUFFER_SIZE = 1024 * 1024
+# A resumable upload is told apart from other files of the same size and modification time by the
+# hash of this many bytes from its start and its end.
+FINGERPRINT_SIZE = 64 * 1024
+
+# Each algorithm's name and how to make a new hash with it, in order of preference.
+ALGORITHMS = {}
+if xxhash is not None:
+    ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+ALGORITHMS['blake2b'] = lambda: hashlib.blake2b(digest_size=32)
+ALGORITHMS['sha256'] = hashlib.sha256
+
+
+def available_algorithms():
+    return list(ALGORITHMS)
+
+
+def choose_algorithm(offered):
+    # The first of the algorithms offered that we can use, or None.
+    for algorithm in offered or []:
+        if algorithm in ALGORITHMS:
+            return algorithm
+    return None
+
+
+def new_hash(algorithm):
+    return ALGORITHMS[algorithm]()
+
+
+def hash_range(hasher, read, offset, count, buffer_size=HASH_BUFFER_SIZE):
+    # Add count bytes from offset, read with read(offset, view), to hasher. Returns the number
+    # of bytes hashed, fewer if the file is shorter.
+    view = memoryview(bytearray(min(buffer_size, max(count, 1))))
+    hashed = 0
+    while hashed < count:
+        n = read(offset + hashed, view[:min(len(view), count - hashed)])
+        if not n:
+            break
+        hasher.update(view[:n])
+        hashed += n
+    return hashed
+
+
+def fingerprint(read, size):
+    # A quick hash of a file's first and last FINGERPRINT_SIZE bytes, read with read(offset, view).
+    hasher = hashlib.sha256()
+    hash_range(hasher, read, 0, min(size, FINGERPRINT_SIZE))
+    if size > FINGERPRINT_SIZE:
+        tail = max(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE)
+        hash_range(hasher, read, tail, size - tail)
+    return hasher.hexdigest()
+
+
+class BackgroundHash:
+    # Hashes a file on a thread of its own while the same bytes are sent zero-copy, which never
+    # brings them into our memory. Hashing releases the GIL, so it overlaps the sending.
+    def __init__(self, algorithm, read, count):
+        self.hasher = new_hash(algorithm)
+        self.read = read
+        self.count = count
+        self.hashed = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='hash', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.hashed = hash_range(self.hasher, self.read, 0, self.count)
+        except OSError as e:
+            self.error = e
+
+    def hexdigest(self):
+        # Wait for the hash to finish, None if the file couldn't be read in full.
+        self.thread.join()
+        if self.error is not None or self.hashed != self.count:
+            return None
+        return self.hasher.hexdigest()
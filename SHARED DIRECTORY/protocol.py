@@ -0,0 +1,417 @@
+import errno
+import json
+import os
+import queue
+import socket
+import threading
+
+# Version 1 is the original protocol, 32 bit sizes and unframed replies. Version 2 uses
+# 64 bit sizes, sends every variable length field with a length prefix, and carries
+# the options of each operation as a JSON frame.
+LEGACY_VERSION = 1
+PROTOCOL_VERSION = 2
+SUPPORTED_VERSIONS = (LEGACY_VERSION, PROTOCOL_VERSION)
+
+# The 4 byte operations sent from the client to the server.
+CONN = b'CONN'
+VERS = b'VERS'
+UPLD = b'UPLD'
+LIST = b'LIST'
+DWLD = b'DWLD'
+DELF = b'DELF'
+QUIT = b'QUIT'
+# Batch operations, a manifest followed by the file bodies back to back.
+MUPL = b'MUPL'
+MDWL = b'MDWL'
+# Ranged operations, used to move one file in segments over several connections at once.
+RDWL = b'RDWL'
+RUPL = b'RUPL'
+RFIN = b'RFIN'
+# Deduplicated upload, the client sends only the chunks of the file the server doesn't hold.
+DDUP = b'DDUP'
+# The server's counters, gauges and latency histograms.
+STAT = b'STAT'
+# Keep-alive, the server answers straight away with PING. Lets a client check an idle connection
+# is still alive before using it, and keeps firewalls and NAT from forgetting it.
+PING = b'PING'
+# Reads and, from the server's own host, changes the server's bandwidth limits.
+LIMT = b'LIMT'
+
+# The 3 byte replies to an upload request.
+ACK = b'ACK'
+NAK = b'NAK'
+
+# How many bytes of a file are moved per read/recv when zero-copy sendfile is not used.
+CHUNK_SIZE = 1024 * 1024
+# How many bytes the buffered reader asks the socket for at once.
+READ_BUFFER_SIZE = 64 * 1024
+# How many buffers a pipelined receive fills ahead of the disk, two is double buffering.
+PIPELINE_DEPTH = 4
+# Whether the operating system can send a file straight from the page cache to a socket.
+ZERO_COPY = hasattr(os, 'sendfile')
+# When a transfer reports its progress, sendfile sends this many bytes at a time between reports.
+PROGRESS_WINDOW = 8 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    # Raised when the other side sends something the protocol does not allow.
+    pass
+
+
+class BufferedReader:
+    # Reads the fields of the protocol from a socket, receiving as much as is available at once
+    # so small fields don't cost a syscall each.
+    def __init__(self, sock, buffer_size=READ_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # The unread bytes are buffer[start:end].
+        self.start = 0
+        self.end = 0
+
+    def buffered(self):
+        return self.end - self.start
+
+    def fill(self):
+        # Receive more bytes into the buffer, returns False if the connection was closed.
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            # Move the unread bytes to the front to make room.
+            unread = self.end - self.start
+            self.buffer[:unread] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, unread
+        bytes_received = self.sock.recv_into(self.view[self.end:])
+        self.end += bytes_received
+        return bytes_received > 0
+
+    def read_exact(self, n):
+        # Return exactly n bytes, raising ConnectionError if the connection closes first.
+        if n <= self.buffered():
+            data = bytes(self.view[self.start:self.start + n])
+            self.start += n
+            return data
+        data = bytearray(n)
+        received = self.readinto_exact(memoryview(data))
+        if received < n:
+            raise ConnectionError('connection closed after ' + str(received) + ' of ' + str(n) + ' bytes.')
+        return bytes(data)
+
+    def read_some(self, n):
+        # Return between 1 and n bytes, or no bytes if the connection was closed.
+        if not self.buffered() and not self.fill():
+            return b''
+        data = bytes(self.view[self.start:self.start + min(n, self.buffered())])
+        self.start += len(data)
+        return data
+
+    def readinto(self, view):
+        # Fill as much of view as one read allows, returns 0 if the connection was closed.
+        if not self.buffered():
+            if len(view) >= len(self.buffer):
+                # Large reads go straight into the caller's buffer.
+                return self.sock.recv_into(view)
+            # Small reads fill our buffer, so back to back small files cost one recv between them.
+            if not self.fill():
+                return 0
+        # Hand over what is already buffered first.
+        n = min(len(view), self.buffered())
+        view[:n] = self.view[self.start:self.start + n]
+        self.start += n
+        return n
+
+    def readinto_exact(self, view):
+        # Fill all of view, returns fewer bytes only if the connection was closed.
+        received = 0
+        while received < len(view):
+            bytes_received = self.readinto(view[received:])
+            if not bytes_received:
+                break
+            received += bytes_received
+        return received
+
+    def read_opcode(self):
+        # Return the next 4 byte operation, or an empty string if the client has gone away.
+        if not self.buffered() and not self.fill():
+            return ''
+        return self.read_exact(4).decode()
+
+    def read_int(self, width, signed=False):
+        return int.from_bytes(self.read_exact(width), 'little', signed=signed)
+
+    def read_size(self, version=PROTOCOL_VERSION, signed=False):
+        return self.read_int(size_width(version), signed)
+
+    def read_name(self):
+        # File names are sent as a 2 byte length followed by the name.
+        return self.read_exact(self.read_int(2)).decode()
+
+    def read_frame(self):
+        # Frames are sent as a 4 byte length followed by the payload.
+        return self.read_exact(self.read_int(4))
+
+    def read_string(self):
+        return self.read_frame().decode()
+
+    def read_options(self):
+        options = json.loads(self.read_frame().decode())
+        if not isinstance(options, dict):
+            raise ProtocolError('options must be a JSON object.')
+        return options
+
+
+def size_width(version):
+    # File sizes are 32 bit in the original protocol and 64 bit since.
+    return 4 if version == LEGACY_VERSION else 8
+
+
+def pack_int(value, width, signed=False):
+    return value.to_bytes(width, 'little', signed=signed)
+
+
+def pack_size(size, version=PROTOCOL_VERSION, signed=False):
+    return pack_int(size, size_width(version), signed)
+
+
+def pack_name(name):
+    if isinstance(name, str):
+        name = name.encode()
+    return pack_int(len(name), 2) + name
+
+
+def pack_frame(payload):
+    return pack_int(len(payload), 4) + payload
+
+
+def pack_string(string):
+    return pack_frame(string.encode())
+
+
+def pack_options(options):
+    return pack_frame(json.dumps(options, separators=(',', ':')).encode())
+
+
+def tune_socket(sock, send_buffer=None, receive_buffer=None):
+    # Send requests and replies as soon as they are written rather than holding small ones back
+    # to join them with more (Nagle's algorithm), which stalls a request/reply exchange until the
+    # other end's delayed acknowledgement. Socket buffer sizes are only set if given, setting one
+    # turns off the operating system's own tuning of it on Linux.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if send_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    if receive_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+
+
+def send_file(sock, f, count, buffer, progress=None):
+    # Send count bytes of the open file f to sock, starting at the current file position. progress,
+    # if given, is called with the number of bytes sent so far as the file goes.
+    if count <= 0:
+        # sendfile refuses a count of 0, there is nothing to send anyway.
+        return 0
+    if ZERO_COPY and progress is None:
+        # The kernel copies the file straight to the socket, leaving the file position after
+        # the last byte sent.
+        return sock.sendfile(f, f.tell(), count)
+    if ZERO_COPY:
+        # Still zero-copy, a window at a time so there is something to report between windows.
+        offset = f.tell()
+        bytes_sent = 0
+        while bytes_sent < count:
+            sent = sock.sendfile(f, offset + bytes_sent, min(PROGRESS_WINDOW, count - bytes_sent))
+            if not sent:
+                break
+            bytes_sent += sent
+            progress(bytes_sent)
+        return bytes_sent
+    view = memoryview(buffer)
+    bytes_sent = 0
+    while bytes_sent < count:
+        # Read up to a buffer full of the file into the reusable buffer.
+        bytes_read = f.readinto(view[:min(len(view), count - bytes_sent)])
+        if not bytes_read:
+            break
+        # Send exactly the bytes we read without copying them out of the buffer.
+        sock.sendall(view[:bytes_read])
+        bytes_sent += bytes_read
+        if progress is not None:
+            progress(bytes_sent)
+    return bytes_sent
+
+
+def file_reader(f):
+    # Read from an open file at a given offset without moving its file position, so the same file
+    # can be read by another thread, or sent with sendfile, at the same time.
+    if hasattr(os, 'preadv'):
+        return lambda offset, view: os.preadv(f.fileno(), [view], offset)
+
+    def read(offset, view):
+        f.seek(offset)
+        return f.readinto(view)
+    return read
+
+
+def recv_file(reader, f, count, buffer, hasher=None, progress=None):
+    # Receive count bytes from the reader and write them to the open file f, adding them to
+    # hasher as they go by if one is given. progress, if given, is called with the number of
+    # bytes received so far.
+    view = memoryview(buffer)
+    bytes_received = 0
+    while bytes_received < count:
+        # Receive up to a buffer full, never past the end of the file so the bytes of
+        # whatever follows stay in the reader.
+        n = reader.readinto(view[:min(len(view), count - bytes_received)])
+        if not n:
+            break
+        bytes_received += n
+        if hasher is not None:
+            hasher.update(view[:n])
+        f.write(view[:n])
+        if progress is not None:
+            progress(bytes_received)
+    return bytes_received
+
+
+def recv_file_pipelined(reader, f, count, buffers, hasher=None, on_written=None):
+    # Receive count bytes from the reader and write them to the open file f, as recv_file does,
+    # but with a writer thread so one buffer is written to disk while the next is received and
+    # the transfer runs at the speed of the slower of the two rather than their sum. Receiving
+    # waits for a free buffer when the writer falls behind by all of them. on_written, if given,
+    # is called from the writer thread with the number of bytes written so far.
+    free = queue.SimpleQueue()
+    for buffer in buffers:
+        free.put(buffer)
+    # At most len(buffers) filled buffers are ever waiting, so the queue is bounded by them.
+    filled = queue.SimpleQueue()
+    errors = []
+
+    def write():
+        written = 0
+        while True:
+            item = filled.get()
+            if item is None:
+                return
+            buffer, n = item
+            if not errors:
+                try:
+                    view = memoryview(buffer)[:n]
+                    # Hashing here keeps it off the receiving thread too.
+                    if hasher is not None:
+                        hasher.update(view)
+                    f.write(view)
+                    written += n
+                    if on_written is not None:
+                        on_written(written)
+                except OSError as e:
+                    errors.append(e)
+            free.put(buffer)
+
+    writer = threading.Thread(target=write, name='writer', daemon=True)
+    writer.start()
+    bytes_received = 0
+    try:
+        while bytes_received < count and not errors:
+            buffer = free.get()
+            wanted = min(len(buffer), count - bytes_received)
+            # Fill the buffer, so the disk is written in large pieces.
+            n = reader.readinto_exact(memoryview(buffer)[:wanted])
+            if n:
+                filled.put((buffer, n))
+                bytes_received += n
+            if n < wanted:
+                # The connection was closed.
+                break
+    finally:
+        filled.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return bytes_received
+
+
+def recv_file_at(reader, fd, offset, count, buffer):
+    # Receive count bytes from the reader and write them to the file descriptor fd starting at
+    # offset, several connections can write their own parts of the same file at once.
+    view = memoryview(buffer)
+    bytes_received = 0
+    while bytes_received < count:
+        n = reader.readinto(view[:min(len(view), count - bytes_received)])
+        if not n:
+            break
+        written = 0
+        while written < n:
+            written += os.pwrite(fd, view[written:n], offset + bytes_received + written)
+        bytes_received += n
+    return bytes_received
+
+
+def preallocate(fd, size):
+    # Give the file its final size up front, so segments can be written in any order and the
+    # disk space is reserved before the transfer starts where the filesystem allows it. Raises
+    # OSError, ENOSPC among others, when the space can't be had.
+    if hasattr(os, 'posix_fallocate') and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            # Not every filesystem can reserve space, the file is still given the right size.
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    os.ftruncate(fd, size)
+
+
+def discard_bytes(reader, count, buffer):
+    # Receive and throw away count bytes, keeping the connection in step when a file can't be written.
+    view = memoryview(buffer)
+    bytes_received = 0
+    while bytes_received < count:
+        n = reader.readinto(view[:min(len(view), count - bytes_received)])
+        if not n:
+            break
+        bytes_received += n
+    return bytes_received
+
+
+def send_zeros(sock, count, buffer):
+    # Pad a body that came up short, a file shrinking while it was sent, so the receiver stays in step.
+    view = memoryview(buffer)
+    view[:min(len(view), count)] = bytes(min(len(view), count))
+    while count > 0:
+        n = min(len(view), count)
+        sock.sendall(view[:n])
+        count -= n
+
+
+class Connection:
+    # A client's socket, the reader over it and the protocol version agreed with the server.
+    def __init__(self, sock, version=LEGACY_VERSION):
+        self.sock = sock
+        self.reader = BufferedReader(sock)
+        self.version = version
+        # The optional features the server said it supports.
+        self.features = []
+        # The codec agreed with the server for compressing transfers, None to send files as they are.
+        self.compression = None
+        # The hash algorithm agreed with the server for checking transfers, None not to check them.
+        self.checksum = None
+        # A buffer reused by every transfer over the connection rather than allocating one per chunk.
+        self.buffer = bytearray(CHUNK_SIZE)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def negotiate(connection, options=None):
+    # Sent by the client straight after CONN, asks the server to speak our version.
+    connection.sendall(VERS + pack_int(PROTOCOL_VERSION, 1) + pack_options(options or {}))
+    if connection.reader.read_exact(4) != VERS:
+        raise ProtocolError('server did not answer the version request.')
+    version = connection.reader.read_int(1)
+    server_options = connection.reader.read_options()
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError('server only speaks protocol version ' + str(version) + '.')
+    connection.version = version
+    connection.features = server_options.get('features', [])
+    return server_options